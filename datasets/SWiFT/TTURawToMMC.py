@@ -2,6 +2,17 @@
 ##### Parse raw SWiFT TTU tower data by the hour for 24 hours...
 import os
 import sys
+import glob
+import json
+import time
+import queue
+import hashlib
+import threading
+import uuid
+from string import Formatter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 import numpy as np
 import pandas as pd
 
@@ -23,13 +34,37 @@ sampleRateRaw = 50 # [Hz]
 sampleRateTarg = 1
 
 dap_filenames = 'tower.z01.00.%Y%m%d.%H0000.ttu200m.dat'
+dap_timeformat = '%Y-%m-%d %H:%M:%S.%f' # e.g., '2013-11-08 00:00:00.020'
 starttimes = np.arange(24)              # 00, 01, ..., 23
 endtimes = np.mod(np.arange(1,25), 24)  # 01, 02, ..., 23, 00
 varnames = ['unorth','vwest','w','ustream','vcross','wdir','tsonic','t','p','rh']
 
+# input options
+chunksize = 18000 # rows per chunk when streaming raw files; None to read whole files
+dtype = np.float64 # working precision; np.float32 halves the per-hour memory
+cachedir = None # directory for memory-mapped binary copies of parsed raw files
+usevars = ['unorth','vwest','w','t','p'] # raw variables needed for the output; other columns are not parsed
+prefetch = False # read the next hour in a background thread while processing the current one (serial runs)
+
+# instrumentation
+stagelog = None # JSON-lines file for per-hour, per-stage timing and memory records
+
 # output options
-subSampleByMean = False
+outformat = 'mmc' # 'mmc' for the legacy MMC ASCII format, or 'netcdf'
+mmcfields = ['u','v','w','th','p','tke','tau11','tau12','tau13','tau22','tau23','tau33','hflux']
+decimation = 'mean' # 'point' (every sampleRateRaw/sampleRateTarg-th sample), 'mean' (block means), or 'lowpass' (anti-aliased FIR filter)
+statsWindow = 1.0 # averaging window for TKE, stresses and heat flux [s], at most one file long
 dummyval = -999 # for missing values
+mmcheader = dict(
+    institution='SNL',
+    location='TTUTOWER',
+    latitude=ttu_lat,
+    longitude=ttu_lon,
+    codename='TOWER',
+    codetype='DATA',
+    casename='DIURNAL',
+    benchmark='CASE1',
+)
 
 #JAS 1108-1111, 4-day tilt-corrected
 reg_coefs = [[-0.02047518907375512, -0.011649366757767144, -0.005668625739156408],
@@ -56,277 +91,1535 @@ tilts = [[0.012954624102180665, 0.4528733026774165],
 
 #==============================================================================
 
-def TTURawToMMC(dpath,startdate,outpath):
-    """Read files with 'dap_filenames' format corresponding to
-    'startdate' from 'dpath', write out MMC data to 'outpath', which
-    may be either a file path or a directory path (a default filename
-    will be generated).
+def read_dap_file(fpath,out=None,chunksize=None,cachedir=None,
+                  variables=None,heights=None,dtype=np.float64):
+    """Read an hourly raw DAP file in fixed-size row chunks.
+
+    The file is in wide format, has column headers in the 5th row
+    (irow=4), and datetimes in the first column (icol=0). Column names
+    have variables changing fastest, then heights, i.e.,
+        unorth_3ft,vwest_3ft,...,unorth_8ft,vwest_8ft,...
+
+    Only the columns of the listed 'variables' (names in 'varnames') at
+    the listed 'heights' (in 'ftlevels') are parsed, as type 'dtype' (or
+    the type of 'out'); by default, all of them. Each chunk is copied
+    straight into a (variable,height,time) buffer so that no more than
+    'chunksize' rows of parsed text are held at once. If 'out' is
+    provided, it should have shape (len(variables),len(heights),Nt) and
+    is reused across calls; the file must then have exactly Nt rows. If
+    'chunksize' is None, the whole file is parsed in one go.
+
+    If 'cachedir' is specified, the parsed data are taken from (or, on
+    first use, saved to) a binary cache in that directory; see
+    cached_dap_file(). Without 'out', the returned arrays are then
+    read-only memory maps of the cache.
+
+    Returns the sample times, as int64 nanoseconds since the epoch, and
+    the data buffer, with variables and heights ordered as listed.
     """
-    startdate = pd.to_datetime(startdate)
-    dateStr = startdate.strftime('%Y-%m-%d')
-    print("dateStr = {:s}".format(dateStr))
+    if variables is None:
+        variables = varnames
+    if heights is None:
+        heights = ftlevels
+    if out is not None:
+        dtype = out.dtype
+    if cachedir is not None:
+        times, data = cached_dap_file(fpath,cachedir,chunksize=chunksize,
+                                      dtype=dtype,variables=variables,
+                                      heights=heights)
+        if out is None:
+            return times, data
+        if data.shape != out.shape:
+            raise ValueError('{:s} has {:d} rows, expected {:d}'.format(
+                             fpath,data.shape[2],out.shape[2]))
+        out[:] = data
+        return np.array(times), out
+
+    Nvar = len(variables)
+    Nz = len(heights)
+    if out is None:
+        Nt = sampleRateRaw*60*minutesPerFile
+        out = np.empty((Nvar,Nz,Nt),dtype=dtype)
+    Nt = out.shape[2]
+    times = np.empty(Nt, dtype=np.int64)
+
+    # column indices of the selected variables, in (height,variable) order
+    columns = [1 + ftlevels.index(height)*len(varnames) + varnames.index(varname)
+               for height in heights for varname in variables]
+    reader = pd.read_csv(fpath,skiprows=5,header=None,chunksize=chunksize,
+                         usecols=[0]+columns,
+                         dtype={icol: dtype for icol in columns})
+    if chunksize is None:
+        reader = [reader]
+    i0 = 0
+    for chunk in reader:
+        i1 = i0 + len(chunk)
+        if i1 > Nt:
+            raise ValueError('{:s} has more than {:d} rows'.format(fpath,Nt))
+        times[i0:i1] = parse_timestamps(chunk[0])
+        vals = chunk[columns].to_numpy(dtype=out.dtype)
+        out[:,:,i0:i1] = vals.reshape(-1,Nz,Nvar).transpose(2,1,0)
+        i0 = i1
+    if i0 < Nt:
+        raise ValueError('{:s} has {:d} rows, expected {:d}'.format(fpath,i0,Nt))
+    gaps = find_gaps(times,sampleRateRaw)
+    if len(gaps) > 0:
+        print('Warning: {:d} irregular sample intervals in {:s}, first at {}'.format(
+              len(gaps), fpath, times[gaps[:1]].view('datetime64[ns]')[0]))
+    return times, out
+
+
+def parse_timestamps(strings,timeformat=dap_timeformat):
+    """Parse DAP timestamp strings with the known, fixed 'timeformat'.
+    Returns int64 nanoseconds since the epoch.
+
+    With an explicit format, pandas parses the whole array in compiled
+    code instead of inferring the format of each string. If any string
+    does not match 'timeformat' (e.g., whole-second stamps written
+    without fractional digits), all are parsed as ISO 8601 strings,
+    which may differ in precision; pandas >= 2 would otherwise infer a
+    single format from the first string and fail on the others.
+    """
+    try:
+        times = pd.to_datetime(strings,format=timeformat)
+    except ValueError:
+        try:
+            times = pd.to_datetime(strings,format='ISO8601')
+        except ValueError:
+            # pandas < 2, which infers the format of each string
+            times = pd.to_datetime(strings)
+    return np.asarray(times,dtype='datetime64[ns]').view(np.int64)
+
+
+def find_gaps(times,sampleRate):
+    """Return the indices i at which times[i+1]-times[i] differs from
+    the sampling interval (1/'sampleRate' seconds) by more than 1% of
+    that interval, i.e., gaps, repeats or jumps in int64 nanosecond
+    sample times.
+    """
+    dt = 1e9/sampleRate
+    return np.nonzero(np.abs(np.diff(times) - dt) > 0.01*dt)[0]
+
+
+def _dap_cache_paths(fpath,cachedir,dtype=np.float64,variables=None,
+                     heights=None):
+    """Paths of the binary cache files of the raw DAP file 'fpath' (see
+    cached_dap_file()): the prefix shared by all caches of the raw file
+    (named after its absolute path, so that files with the same name in
+    different directories do not collide), the stem shared by all caches
+    of its current version, and the data and times .npy files of the
+    selected 'dtype', 'variables' and 'heights'
+    """
+    if variables is None:
+        variables = varnames
+    if heights is None:
+        heights = ftlevels
+    fpath = os.path.abspath(fpath)
+    location = hashlib.md5(fpath.encode()).hexdigest()[:16]
+    prefix = '{:s}.{:s}'.format(os.path.join(cachedir,os.path.basename(fpath)),
+                                location)
+    st = os.stat(fpath)
+    identity = '{:d}:{:d}'.format(st.st_size,st.st_mtime_ns)
+    identity = hashlib.md5(identity.encode()).hexdigest()[:16]
+    selection = '{:s}:{:s}:{:s}'.format(np.dtype(dtype).str, ','.join(variables),
+                                        ','.join(str(height) for height in heights))
+    selection = hashlib.md5(selection.encode()).hexdigest()[:16]
+    stem = '{:s}.{:s}'.format(prefix,identity)
+    datapath = '{:s}.{:s}.data.npy'.format(stem,selection)
+    timespath = '{:s}.{:s}.times.npy'.format(stem,selection)
+    return prefix, stem, datapath, timespath
+
+
+def cached_dap_file(fpath,cachedir,chunksize=chunksize,dtype=np.float64,
+                    variables=None,heights=None):
+    """Return memory-mapped, read-only (times,data) arrays for the raw
+    DAP file 'fpath', as returned by read_dap_file().
+
+    The first time a file is requested, it is parsed straight into a
+    memory-mapped .npy file in 'cachedir', next to an .npy file with
+    the int64 sample times. Cache files are keyed by the absolute path,
+    size and modification time of the raw file, and separately by
+    'dtype' and the selected 'variables' and 'heights'. A changed raw
+    file is reparsed and all of its stale caches removed, while caches
+    of other selections from an unchanged file are kept. Later requests
+    just map the cached arrays, skipping the text parsing.
+    """
+    if variables is None:
+        variables = varnames
+    if heights is None:
+        heights = ftlevels
+    prefix, stem, datapath, timespath = _dap_cache_paths(fpath,cachedir,dtype,
+                                                         variables,heights)
+    if not (os.path.isfile(datapath) and os.path.isfile(timespath)):
+        os.makedirs(cachedir,exist_ok=True)
+        for stalepath in glob.glob(glob.escape(prefix)+'.*.npy'):
+            if not stalepath.startswith(stem+'.'):
+                try:
+                    os.remove(stalepath)
+                except FileNotFoundError:
+                    pass
+        # parse into temporary files, then move them into place so that
+        # an interrupted or concurrent conversion never leaves a partial
+        # cache behind
+        suffix = '.{:d}.tmp'.format(os.getpid())
+        Nt = sampleRateRaw*60*minutesPerFile
+        shape = (len(variables),len(heights),Nt)
+        try:
+            data = np.lib.format.open_memmap(datapath+suffix, mode='w+',
+                                             dtype=dtype, shape=shape)
+            times,_ = read_dap_file(fpath,out=data,chunksize=chunksize,
+                                    variables=variables,heights=heights)
+            data.flush()
+            del data
+            with open(timespath+suffix,'wb') as f:
+                np.save(f,times)
+        except:
+            for tmppath in [datapath+suffix, timespath+suffix]:
+                if os.path.isfile(tmppath):
+                    os.remove(tmppath)
+            raise
+        os.replace(timespath+suffix,timespath)
+        os.replace(datapath+suffix,datapath)
+
+    times = np.load(timespath,mmap_mode='r')
+    data = np.load(datapath,mmap_mode='r')
+    return times, data
+
+
+def tilt_correction_matrices(reg_coefs,tilts):
+    """Express the tilt correction of mmctools.measurements.metmast as a
+    rotation matrix and offset for each tower level, such that the
+    corrected velocity at level k is rotation[k] @ [u,v,w] + offset[k].
+
+    The correction is affine in (u,v,w) for fixed 'reg_coefs' and
+    'tilts', so the matrices are found by correcting a zero vector and
+    the three unit vectors at every level. Returns arrays with shapes
+    (Nz,3,3) and (Nz,3).
+    """
+    Nz = len(tilts)
+    # probe samples (rows): zero, then unit u, v and w
+    probe = np.zeros((3,4,Nz))
+    for i in range(3):
+        probe[i,i+1,:] = 1.0
+    corrected = np.stack(tilt_correction(*probe,reg_coefs,tilts)) # (3,4,Nz)
+    offset = corrected[:,0,:].T.copy()
+    rotation = (corrected[:,1:,:] - corrected[:,:1,:]).transpose(2,0,1)
+    return rotation, offset
+
+
+def apply_tilt_correction(u,v,w,rotation,offset,chunksize=None):
+    """Tilt-correct (height,time) velocity arrays 'u', 'v' and 'w' in
+    place, given the per-level 'rotation' matrices and 'offset' vectors
+    from tilt_correction_matrices(). Samples are processed in blocks of
+    'chunksize' (default: all at once), so only a block-sized copy of
+    the uncorrected velocities is held at any time.
+    """
+    Nz,Nt = u.shape
+    step = chunksize or Nt
+    rotation = rotation.astype(u.dtype)[:,:,:,np.newaxis]
+    offset = offset.astype(u.dtype)[:,:,np.newaxis]
+    tmp = np.empty((Nz,min(step,Nt)),dtype=u.dtype)
+    for i0 in range(0,Nt,step):
+        i1 = min(i0+step,Nt)
+        x = np.stack([u[:,i0:i1],v[:,i0:i1],w[:,i0:i1]])
+        tmp1 = tmp[:,:i1-i0]
+        for i,y in enumerate([u,v,w]):
+            out = y[:,i0:i1]
+            np.multiply(rotation[:,i,0],x[0],out=out)
+            for j in (1,2):
+                np.multiply(rotation[:,i,j],x[j],out=tmp1)
+                out += tmp1
+            out += offset[:,i]
+
+
+class Decimator(object):
+    """Reduce the sample rate of (...,time) arrays by an integer
+    'factor', one chunk at a time, with one of the following modes:
+
+    - 'point': take the first sample of every block of 'factor' samples
+    - 'mean': NaN-aware mean over each block of 'factor' samples
+    - 'lowpass': anti-aliasing FIR filter centered on the first sample
+      of each block, i.e., a Hamming-windowed sinc with its cutoff at
+      the output Nyquist frequency, spanning 'halfwidth' output samples
+      on either side (as in scipy.signal.decimate), evaluated in
+      polyphase form
+
+    Each output sample is a weighted sum of valid (finite) input samples
+    divided by the sum of the weights used, so missing samples and the
+    ends of a record are handled by renormalizing the filter. Chunks
+    are added with accumulate(), which adds their weighted sums into
+    the outputs they affect: in 'lowpass' mode, a chunk also affects
+    'overlap' = 'halfwidth' outputs before and after it. Because the
+    sums are simply added, consecutive records may be decimated
+    separately and joined by adding their sums where they overlap.
+    """
+    modes = ['point','mean','lowpass']
+
+    def __init__(self,factor,mode='mean',halfwidth=10):
+        if mode not in self.modes:
+            raise ValueError('Unknown decimation mode {:s}'.format(str(mode)))
+        self.factor = factor
+        self.mode = mode
+        self.overlap = halfwidth if mode == 'lowpass' else 0
+        if mode == 'lowpass':
+            # weights[i,p] applies to phase p of an input block and
+            # contributes to the output i-halfwidth blocks later
+            D = factor
+            c = halfwidth*D
+            k = np.arange(2*c+1)
+            h = np.sinc((k-c)/D) * np.hamming(2*c+1)
+            h /= h.sum()
+            h = np.concatenate([h,np.zeros(D-1)])
+            self.weights = h.reshape(-1,D)[::-1].copy()
+
+    def accumulate(self,x,num,den):
+        """Add the weighted sums of chunk 'x' (...,B*factor), which
+        starts at the first sample of a block, to 'num' and the sums of
+        weights to 'den'; both have shape (...,B+2*overlap), starting
+        'overlap' outputs before the chunk
+        """
+        D = self.factor
+        if x.shape[-1] % D > 0:
+            raise ValueError('{:d} samples do not divide into blocks of {:d}'.format(x.shape[-1],D))
+        valid = np.isfinite(x)
+        if self.mode == 'point':
+            num += np.where(valid[...,::D],x[...,::D],0)
+            den += valid[...,::D]
+            return
+        blockshape = x.shape[:-1] + (-1,D)
+        xb = np.where(valid,x,0).reshape(blockshape)
+        if self.mode == 'mean':
+            num += np.sum(xb,axis=-1)
+            den += np.sum(valid.reshape(blockshape),axis=-1)
+            return
+        vb = valid.reshape(blockshape).astype(xb.dtype)
+        B = xb.shape[-2]
+        for i,weights in enumerate(self.weights.astype(xb.dtype)):
+            num[...,i:i+B] += xb @ weights
+            den[...,i:i+B] += vb @ weights
+
+    @staticmethod
+    def ratio(num,den):
+        """Decimated values from accumulated sums; NaN where no valid
+        samples contributed
+        """
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return num / den
+
+
+class MomentAccumulator(object):
+    """Streaming, mergeable first and second moments of u, v, w and th
+    at each height, accumulated over consecutive averaging windows of
+    'window' seconds aligned to multiples of the window since the epoch.
+
+    Data are added in time order with update(), one chunk at a time;
+    each chunk is reduced to per-window counts, means and co-moments
+    about those means, which are then combined with the running totals
+    using the pairwise update of Chan et al. (1979). Two accumulators
+    over the same windows may likewise be combined with merge(). A
+    sample only counts towards the statistics at a height if all of
+    u, v, w and th are valid there.
+    """
+    # co-moment (variable,variable) pairs in mmcfields order
+    pairs = [(0,0),(0,1),(0,2),(1,1),(1,2),(2,2),(3,2)]
+
+    def __init__(self,Nz,tstart,tend,window=1.0,dtype=np.float64):
+        """'tstart' and 'tend' (int64 nanoseconds since the epoch) are
+        the first and last sample times to be accumulated
+        """
+        self.window = int(round(window*1e9))
+        if self.window <= 0:
+            raise ValueError('Averaging window must be positive')
+        self.t0 = tstart - tstart % self.window
+        Nwin = (tend - self.t0)//self.window + 1
+        self.n = np.zeros((Nz,Nwin),dtype=np.int64)
+        self.mean = np.zeros((4,Nz,Nwin),dtype=dtype)
+        self.comoment = np.zeros((len(self.pairs),Nz,Nwin),dtype=dtype)
+
+    def window_index(self,times):
+        """Index of the averaging window holding each of 'times'"""
+        return (np.asarray(times) - self.t0)//self.window
+
+    def update(self,times,u,v,w,th):
+        """Add a chunk of (height,time) samples at int64 'times'"""
+        x = np.stack([u,v,w,th])
+        valid = np.isfinite(x).all(axis=0)
+        x[:,~valid] = 0
+        iwin = self.window_index(times)
+        # drop samples (e.g., glitched timestamps) outside the windows
+        inside = (iwin >= 0) & (iwin < self.n.shape[1])
+        if not np.all(inside):
+            x, valid, iwin = x[:,:,inside], valid[:,inside], iwin[inside]
+            if len(iwin) == 0:
+                return
+        starts = np.concatenate([[0],np.nonzero(np.diff(iwin))[0]+1])
+        nb = np.add.reduceat(valid,starts,axis=-1).astype(np.int64)
+        meanb = np.add.reduceat(x,starts,axis=-1) / np.maximum(nb,1)
+        # deviations from the chunk means, zero where invalid
+        local = np.repeat(np.arange(len(starts)),np.diff(np.append(starts,len(iwin))))
+        x -= meanb[:,:,local]
+        x *= valid
+        Cb = np.stack([np.add.reduceat(x[i]*x[j],starts,axis=-1)
+                       for i,j in self.pairs])
+        # runs of samples in the same window (after a backward time
+        # jump) are combined one at a time
+        iwin = iwin[starts]
+        while len(iwin) > 0:
+            _,first = np.unique(iwin,return_index=True)
+            self._combine(iwin[first],nb[:,first],meanb[:,:,first],Cb[:,:,first])
+            rest = np.ones(len(iwin),dtype=bool)
+            rest[first] = False
+            iwin, nb, meanb, Cb = iwin[rest], nb[:,rest], meanb[:,:,rest], Cb[:,:,rest]
+
+    def select(self,iwin):
+        """A new accumulator holding a copy of window 'iwin' only, e.g.
+        to be merged with the same window of a neighboring file
+        """
+        return MomentAccumulator.from_arrays(
+                self.window, self.t0 + iwin*self.window, self.n[:,iwin:iwin+1],
+                self.mean[:,:,iwin:iwin+1], self.comoment[:,:,iwin:iwin+1])
+
+    def arrays(self):
+        """The state of the accumulator as a dict of arrays, from which
+        from_arrays() recreates it (e.g., after saving with np.savez)
+        """
+        return dict(window=self.window, t0=self.t0, n=self.n,
+                    mean=self.mean, comoment=self.comoment)
+
+    @classmethod
+    def from_arrays(cls,window,t0,n,mean,comoment):
+        """An accumulator with the state returned by arrays(); 'window'
+        is in int64 nanoseconds
+        """
+        self = cls.__new__(cls)
+        self.window = int(window)
+        self.t0 = np.int64(t0)
+        self.n = np.array(n)
+        self.mean = np.array(mean)
+        self.comoment = np.array(comoment)
+        return self
+
+    def merge(self,other):
+        """Combine the moments accumulated by 'other' into this one"""
+        if (other.window,other.t0) != (self.window,self.t0):
+            raise ValueError('Accumulators have different averaging windows')
+        N = min(self.n.shape[1],other.n.shape[1])
+        self._combine(np.arange(N),other.n[:,:N],other.mean[:,:,:N],
+                      other.comoment[:,:,:N])
+
+    def _combine(self,iwin,nb,meanb,Cb):
+        na = self.n[:,iwin]
+        n = na + nb
+        delta = meanb - self.mean[:,:,iwin]
+        self.mean[:,:,iwin] += delta * (nb / np.maximum(n,1))
+        weight = na * nb / np.maximum(n,1)
+        for k,(i,j) in enumerate(self.pairs):
+            self.comoment[k][:,iwin] += Cb[k] + delta[i]*delta[j]*weight
+        self.n[:,iwin] = n
+
+    def statistics(self,times=None):
+        """Returns an array with shape (8,Nz,Nwin) holding TKE, TAU11,
+        TAU12, TAU13, TAU22, TAU23, TAU33 and HFLUX for each window, or
+        for the windows holding each of int64 'times' if given. Windows
+        without valid samples, and times outside all windows, are NaN.
+        """
+        with np.errstate(invalid='ignore',divide='ignore'):
+            cov = self.comoment / self.n
+        stats = np.concatenate([cov[:1]+cov[3:4]+cov[5:6],cov])
+        if times is not None:
+            iwin = self.window_index(times)
+            inside = (iwin >= 0) & (iwin < self.n.shape[1])
+            stats = stats[:,:,np.where(inside,iwin,0)]
+            stats[:,:,~inside] = np.nan
+        return stats
+
+
+def write_mmc_records(fout,times,z,fields,
+                      ustar=0.25607,z0=0.1,T0=dummyval,qwall=dummyval):
+    """Write a block of records in the legacy MMC ASCII format.
+
+    'times' are the record times (datetime64 or int64 nanoseconds since
+    the epoch), from which the date and time of each record are taken,
+    'z' the Nz heights and 'fields' an
+    array with shape (len(mmcfields),Nz,Nt) as returned by process_hour(). The
+    'record' and 'datarow' templates are combined into a single format
+    string covering the whole block, so that all records are formatted
+    with one call and written with one write. The output is identical
+    to formatting each record and data row separately.
+    """
+    Nz = len(z)
+    Nt = len(times)
+    # format the constant parts of the record header once, leaving
+    # placeholders for the date and time
+    placeholders = {'date':'\0', 'time':'\1'}
+    rec = record.format(ustar=ustar, z0=z0, T0=T0, qwall=qwall, **placeholders)
+    rec = rec.replace('{','{{').replace('}','}}')
+    order = sorted(placeholders, key=lambda key: rec.index(placeholders[key]))
+    for key in order:
+        rec = rec.replace(placeholders[key],'{}')
+    template = (rec + Nz*datarow) * Nt
+
+    # arguments in template order: date and time, then all columns for
+    # each height
+    # - 'YYYY-MM-DDThh:mm:ss' --> 'YYYY-MM-DD', ' hh:mm:ss'
+    times = np.asarray(times)
+    if times.dtype.kind != 'M':
+        times = times.astype('datetime64[ns]')
+    timestrs = np.datetime_as_string(times.astype('datetime64[s]'))
+    strs = {
+        'date': [timestr[:10] for timestr in timestrs],
+        'time': [' '+timestr[11:] for timestr in timestrs],
+    }
+    cols = np.concatenate([np.broadcast_to(z[np.newaxis,:,np.newaxis],(1,Nz,Nt)),
+                           fields])
+    args = np.empty((Nt,len(order)+cols.shape[0]*Nz), dtype=object)
+    for i,key in enumerate(order):
+        args[:,i] = strs[key]
+    args[:,len(order):] = cols.transpose(2,1,0).reshape(Nt,-1)
+    fout.write(template.format(*args.ravel()))
+
+
+class MMCWriter(object):
+    """Write records to a file in the legacy MMC ASCII format"""
+
+    def __init__(self,fpath,z,**metadata):
+        """Open 'fpath' and write the MMC file-header metadata for
+        heights 'z'
+        """
+        self.z = np.asarray(z)
+        self.fout = open(fpath,'w')
+        self.fout.write(header.format(levels=len(z),**metadata))
+
+    def write(self,times,fields):
+        """Append records at 'times' for 'fields' with shape
+        (len(mmcfields),Nz,Nt)
+        """
+        write_mmc_records(self.fout,times,self.z,fields)
+
+    def flush(self):
+        self.fout.flush()
+
+    def close(self):
+        self.fout.close()
+
+
+class NetCDFWriter(object):
+    """Write records to a chunked, compressed netCDF4 file
+
+    Each of 'mmcfields' is stored as a (datetime,height) variable in
+    chunks of 'chunklen' records by all heights, in single precision
+    (ample for the 3 decimals of the ASCII format), and the MMC header
+    metadata are stored as global attributes. The 'datetime' dimension
+    is unlimited, so records are appended as they are processed.
+
+    The output may be opened lazily with xarray.open_dataset(), and
+    selecting a time or height range only decompresses the chunks that
+    overlap it. Missing values (dummyval) are decoded as NaN.
+    """
+    units = {
+        'u': 'm/s', 'v': 'm/s', 'w': 'm/s',
+        'th': 'K',
+        'p': 'mbar',
+        'tke': 'm^2/s^2',
+        'tau11': 'm^2/s^2', 'tau12': 'm^2/s^2', 'tau13': 'm^2/s^2',
+        'tau22': 'm^2/s^2', 'tau23': 'm^2/s^2', 'tau33': 'm^2/s^2',
+        'hflux': 'K m/s',
+    }
+
+    def __init__(self,fpath,z,chunklen=3600,complevel=4,**metadata):
+        """Create 'fpath' with heights 'z' and global attributes
+        'metadata'
+        """
+        import netCDF4
+        Nz = len(z)
+        self.ds = netCDF4.Dataset(fpath,'w')
+        self.ds.setncatts(dict(levels=Nz,**metadata))
+        self.ds.createDimension('datetime',None)
+        self.ds.createDimension('height',Nz)
+        hgt = self.ds.createVariable('height','f8',('height',))
+        hgt.units = 'm'
+        hgt[:] = z
+        self.times = self.ds.createVariable('datetime','i8',('datetime',),
+                                            chunksizes=(chunklen,))
+        self.times.units = 'milliseconds since 1970-01-01 00:00:00'
+        self.vars = []
+        for fieldname in mmcfields:
+            var = self.ds.createVariable(fieldname,'f4',('datetime','height'),
+                                         zlib=True, complevel=complevel,
+                                         shuffle=True,
+                                         chunksizes=(chunklen,Nz),
+                                         fill_value=dummyval)
+            var.units = self.units[fieldname]
+            var.set_auto_mask(False)
+            self.vars.append(var)
+
+    def write(self,times,fields):
+        """Append records at 'times' (int64 nanoseconds since the epoch)
+        for 'fields' with shape (len(mmcfields),Nz,Nt)
+        """
+        i0 = len(self.times)
+        i1 = i0 + len(times)
+        self.times[i0:i1] = np.asarray(times,dtype=np.int64) // 1000000
+        for var,field in zip(self.vars,fields):
+            var[i0:i1,:] = field.T
+
+    def flush(self):
+        self.ds.sync()
+
+    def close(self):
+        self.ds.close()
+
+
+class MMCReader(object):
+    """Read records from a file in the legacy MMC ASCII format, as
+    written by MMCWriter.
+
+    The layout of the file is taken from the 'header', 'record' and
+    'datarow' templates of mmctools.mmcdata. The header metadata and
+    surface values (ustar, z0, T0, qwall; constant in files from this
+    script) are parsed on opening. Every record then has the same size
+    in bytes, so any record can be found without reading the ones before
+    it: read() locates the first and last records in a time range by
+    bisection, and tokenizes all data rows in the range at once as
+    fixed-width fields.
+    """
+
+    def __init__(self,fpath):
+        self.fpath = fpath
+        self.f = open(fpath,'rb')
+        self.filesize = os.path.getsize(fpath)
+
+        # header: one line per template line
+        self.metadata = {}
+        for template in header.splitlines():
+            line = self.f.readline().decode().rstrip('\n')
+            self.metadata.update(self._parse_line(template,line))
+        self.start = self.f.tell()
+        Nz = self.metadata['levels']
+
+        # first record, to get the record size and the positions of the
+        # date and time within each record
+        reclines = record.splitlines(True)
+        lines = [self.f.readline() for _ in range(len(reclines))]
+        self.rowstart = sum(len(line) for line in lines)
+        rows = [self.f.readline() for _ in range(Nz)]
+        self.recsize = self.rowstart + sum(len(row) for row in rows)
+        self.rowsize = len(rows[0])
+        Nrec,extra = divmod(self.filesize-self.start,self.recsize)
+        if (extra > 0) or any(len(row) != self.rowsize for row in rows):
+            raise ValueError('{:s} does not have fixed-size records'.format(fpath))
+        self.Nrec = Nrec
+        self.surface = {}
+        self.fieldpos = {}
+        pos = 0
+        for template,line in zip(reclines,lines):
+            line = line.decode()
+            for key,val in self._parse_line(template.rstrip('\n'),line.rstrip('\n')).items():
+                if key in ['date','time']:
+                    prefix = template[:template.index('{')]
+                    self.fieldpos[key] = (pos+len(prefix), len(line.rstrip('\n'))-len(prefix))
+                else:
+                    self.surface[key] = val
+            pos += len(line)
+
+        # data rows: fixed-width columns, if the template specifies widths
+        widths = []
+        for _,fieldname,spec,_ in Formatter().parse(datarow):
+            if fieldname is not None:
+                width = ''.join(c for c in spec.split('.')[0] if c.isdigit())
+                widths.append(int(width) if width else None)
+        self.Ncol = len(widths)
+        if (None not in widths) and (len(set(widths)) == 1) \
+                and (self.rowsize == sum(widths) + 1):
+            self.colwidth = widths[0]
+        else:
+            self.colwidth = None
+        self.z = self._parse_rows(b''.join(rows),1)[0,:,0]
+
+    @staticmethod
+    def _parse_line(template,line):
+        """Values of the fields in 'template' (with literal text before
+        each field) found in 'line'
+        """
+        values = {}
+        parts = list(Formatter().parse(template))
+        for (literal,fieldname,spec,_),nextpart in zip(parts,parts[1:]+[None]):
+            if fieldname is None:
+                continue
+            line = line[len(literal):]
+            nextliteral = nextpart[0] if nextpart is not None else ''
+            end = line.index(nextliteral) if nextliteral else len(line)
+            text, line = line[:end].strip(), line[end:]
+            if spec.endswith('d'):
+                values[fieldname] = int(text)
+            elif spec.endswith(('f','e','g')):
+                values[fieldname] = float(text)
+            else:
+                values[fieldname] = text
+        return values
+
+    def _parse_rows(self,buf,Nt):
+        """Tokenize the data rows of 'Nt' records in 'buf' into an array
+        with shape (Nt,Nz,Ncol)
+        """
+        Nz = self.metadata['levels']
+        if self.colwidth is None:
+            vals = np.array(buf.split(),dtype=np.float64)
+        else:
+            # fixed-width columns, dropping the newline at the end of each row
+            chars = np.frombuffer(buf,dtype=np.uint8).reshape(-1,self.rowsize)
+            fields = np.ascontiguousarray(chars[:,:-1]).view('S{:d}'.format(self.colwidth))
+            vals = fields.astype(np.float64)
+        return vals.reshape(Nt,Nz,self.Ncol)
+
+    def _read_times(self,irec,Nt=1,buf=None):
+        """int64 times of records irec,...,irec+Nt-1; 'buf' holds those
+        records if already read
+        """
+        fields = {}
+        for key,(pos,width) in self.fieldpos.items():
+            if buf is None:
+                self.f.seek(self.start + irec*self.recsize + pos)
+                chars = np.frombuffer(self.f.read(width),dtype=np.uint8)
+            else:
+                chars = np.frombuffer(buf,dtype=np.uint8).reshape(Nt,self.recsize)
+                chars = chars[:,pos:pos+width]
+            fields[key] = np.char.strip(np.ascontiguousarray(chars).view('S{:d}'.format(width)).ravel())
+        stamps = np.char.add(np.char.add(fields['date'],b'T'),fields['time'])
+        return stamps.astype('U').astype('datetime64[ns]').view(np.int64)
+
+    def find(self,time):
+        """Index of the first record at or after 'time'"""
+        time = pd.Timestamp(time).value
+        lo, hi = 0, self.Nrec
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._read_times(mid)[0] < time:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read(self,start=None,end=None):
+        """Read the records from time 'start' up to and including 'end'
+        (default: from the first or to the last record). Returns the
+        record times (int64 nanoseconds since the epoch) and an array
+        with shape (len(mmcfields),Nz,Nt), as written by MMCWriter.
+        """
+        i0 = 0 if start is None else self.find(start)
+        i1 = self.Nrec if end is None else self.find(pd.Timestamp(end) + pd.Timedelta(1,'ns'))
+        Nt = max(i1-i0,0)
+        self.f.seek(self.start + i0*self.recsize)
+        buf = self.f.read(Nt*self.recsize)
+        times = self._read_times(i0,Nt,buf)
+        chars = np.frombuffer(buf,dtype=np.uint8).reshape(Nt,self.recsize)
+        rows = chars[:,self.rowstart:].tobytes()
+        vals = self._parse_rows(rows,Nt)
+        # the first column is the height
+        return times, vals[:,:,1:].transpose(2,1,0).copy()
+
+    def to_xarray(self,start=None,end=None):
+        """Read records as in read() into an xarray Dataset laid out like
+        the output of NetCDFWriter, with missing values (dummyval) as NaN
+        """
+        import xarray as xr
+        times, fields = self.read(start,end)
+        fields = np.where(fields == dummyval, np.nan, fields)
+        ds = xr.Dataset(
+            {fieldname: (('datetime','height'), field.T,
+                         {'units': NetCDFWriter.units[fieldname]})
+             for fieldname,field in zip(mmcfields,fields)},
+            coords={'datetime': times.view('datetime64[ns]'),
+                    'height': ('height', self.z, {'units': 'm'})},
+            attrs=dict(self.metadata,**self.surface),
+        )
+        return ds
+
+    def close(self):
+        self.f.close()
+
+
+def convert_units(t,p,th):
+    """Convert (height,time) arrays of temperature 't' from degF to K
+    and pressure 'p' from kPa to mbar in place, and store the potential
+    temperature [K] in 'th'
+    """
+    # unit conversions on temperature(F->K) and pressure( 1 kPa to 10 mbars)
+    t -= 32.
+    t *= 5.
+    t /= 9.
+    t += 273.15
+    p *= 10.
+    R = 287.04
+    cv = 718.0
+    cp = R+cv
+    R_cp = R/cp
+    gamma = cp/cv
+    p00 = 1.0e5 #(Pa)
+    # th = t * (p00 / (100.0*p))**R_cp
+    np.multiply(100.0,p,out=th)
+    np.divide(p00,th,out=th)
+    np.power(th,R_cp,out=th)
+    th *= t
+
+
+def decimate_fields(xs,factor,mode=decimation,chunksize=None):
+    """Decimate the list of (height,time) arrays 'xs' by 'factor' with
+    a Decimator, 'chunksize' samples at a time. Returns an array with
+    shape (len(xs),Nz,Nt/factor) and the filter sums at either end of
+    the record (None unless mode='lowpass').
+    """
+    Nz,Nt = xs[0].shape
+    Nout = Nt // factor
+    decimator = Decimator(factor,mode)
+    K = decimator.overlap
+    num = np.zeros((len(xs),Nz,Nout+2*K),dtype=xs[0].dtype)
+    den = np.zeros((len(xs),Nz,Nout+2*K),dtype=xs[0].dtype)
+    step = max(factor, (chunksize or Nt)//factor*factor)
+    for i0 in range(0,Nt,step):
+        i1 = min(i0+step,Nt)
+        j0 = i0//factor
+        j1 = (i1-1)//factor + 1 + 2*K
+        decimator.accumulate(np.stack([x[:,i0:i1] for x in xs]),
+                             num[:,:,j0:j1], den[:,:,j0:j1])
+    values = decimator.ratio(num[:,:,K:K+Nout], den[:,:,K:K+Nout])
+    if K > 0:
+        # filter sums that spill over into the neighboring records
+        edges = np.stack([np.stack([num[:,:,:2*K],den[:,:,:2*K]]),
+                          np.stack([num[:,:,-2*K:],den[:,:,-2*K:]])])
+    else:
+        edges = None
+    return values, edges
+
+
+def turbulence_statistics(times,u,v,w,th,outputtimes,window=statsWindow,
+                          chunksize=None,duration=None):
+    """TKE, stresses and heat flux over averaging windows of 'window'
+    seconds, accumulated from (height,time) arrays sampled at int64
+    'times' with a MomentAccumulator, 'chunksize' samples at a time.
+    Returns an array with shape (8,Nz,len(outputtimes)) holding the
+    statistics of the window each output time falls in, and
+    accumulators holding the first and last windows, which may be
+    split with the neighboring files (see stitch_hours()).
+
+    The windows cover 'duration' seconds (default: the nominal length
+    of a raw file) from the first sample time; samples stamped outside
+    of them, e.g. by a logger glitch, are ignored. Windows may not be
+    longer than 'duration', so that each is split between at most two
+    files.
+    """
+    Nz,Nt = u.shape
+    if duration is None:
+        duration = 60*minutesPerFile
+    if window > duration:
+        raise ValueError('Averaging window of {:g} s is longer than a file'
+                         ' ({:g} s)'.format(window,duration))
+    # size the windows from the nominal span of the file, not from the
+    # extreme times, which a single corrupt stamp may put anywhere
+    tstart = times[0]
+    tend = tstart + int(round(duration*1e9)) - 1
+    moments = MomentAccumulator(Nz,tstart,tend,window=window,dtype=u.dtype)
+    step = chunksize or Nt
+    for i0 in range(0,Nt,step):
+        i1 = min(i0+step,Nt)
+        moments.update(times[i0:i1],u[:,i0:i1],v[:,i0:i1],w[:,i0:i1],th[:,i0:i1])
+    edges = (moments.select(0), moments.select(moments.n.shape[1]-1))
+    return moments.statistics(outputtimes), edges
+
+
+def _maxrss_MB():
+    """Peak resident memory of this process [MB], or None if unknown"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / 1024.**2 if sys.platform == 'darwin' else maxrss / 1024.
+
+
+class StageLog(object):
+    """Per-hour, per-stage instrumentation of a conversion run.
+
+    Each stage of processing an hourly file is timed with stage(), and
+    a record of its wall time, the rows processed, the bytes read and
+    written, and the peak RSS of the process is appended to the
+    JSON-lines file 'logpath' as soon as the stage completes. Worker
+    processes append to the same file; all records of a run share the
+    'run' identifier, from which summary() totals them up at the end.
+    With logpath=None, stage() only runs the enclosed code, so the
+    instrumentation can be left in place at no cost.
+    """
+
+    def __init__(self,logpath=None,run=None):
+        self.logpath = logpath
+        if (run is None) and (logpath is not None):
+            # unique even for runs started in the same second
+            run = '{:s}-{:s}'.format(pd.Timestamp.now().strftime('%Y%m%dT%H%M%S'),
+                                     uuid.uuid4().hex)
+        self.run = run
+
+    @property
+    def enabled(self):
+        return self.logpath is not None
+
+    @contextmanager
+    def stage(self,name,source,**counts):
+        """Time the enclosed code as stage 'name' of processing
+        'source'. Yields a dict of counts (rows, bytes_read,
+        bytes_written), which the enclosed code may update.
+        """
+        if self.logpath is None:
+            yield counts
+            return
+        tstart = time.perf_counter()
+        yield counts
+        record = dict(
+            run=self.run,
+            source=os.path.basename(source),
+            stage=name,
+            pid=os.getpid(),
+            wall_s=time.perf_counter() - tstart,
+            rows=counts.get('rows',0),
+            bytes_read=counts.get('bytes_read',0),
+            bytes_written=counts.get('bytes_written',0),
+            maxrss_MB=_maxrss_MB(),
+        )
+        self._append(record)
+
+    def _append(self,record):
+        # a single write per line, so that lines from concurrent worker
+        # processes do not interleave
+        line = (json.dumps(record) + '\n').encode()
+        fd = os.open(self.logpath,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+        try:
+            os.write(fd,line)
+        finally:
+            os.close(fd)
+
+    def summary(self,elapsed=None):
+        """Total the records of this run by stage, append the totals to
+        the log as a summary record and return them (None if logging is
+        off). 'elapsed' is the overall wall time of the run [s].
+        """
+        if self.logpath is None:
+            return None
+        stages = {}
+        sources = set()
+        maxrss = 0.
+        lines = []
+        if os.path.isfile(self.logpath):
+            with open(self.logpath) as f:
+                lines = f.readlines()
+        for line in lines:
+            record = json.loads(line)
+            if (record.get('run') != self.run) or ('stage' not in record):
+                continue
+            if record['stage'] == 'read':
+                sources.add(record['source'])
+            totals = stages.setdefault(record['stage'],
+                    dict(calls=0,wall_s=0.,rows=0,bytes_read=0,bytes_written=0))
+            totals['calls'] += 1
+            for key in ['wall_s','rows','bytes_read','bytes_written']:
+                totals[key] += record[key]
+            maxrss = max(maxrss,record['maxrss_MB'] or 0.)
+        summary = dict(run=self.run,summary=stages,files=len(sources),
+                       elapsed_s=elapsed,maxrss_MB=maxrss)
+        self._append(summary)
+        return summary
+
+
+def print_stage_summary(summary):
+    """Print the totals returned by StageLog.summary()"""
+    if summary is None:
+        return
+    MB = 1024.**2
+    print('Stage summary for {:d} files (run {:s}):'.format(summary['files'],summary['run']))
+    for name,totals in summary['summary'].items():
+        print('  {:10s} {:8.2f} s {:10d} rows {:9.1f} MB read {:9.1f} MB written'.format(
+              name, totals['wall_s'], totals['rows'],
+              totals['bytes_read']/MB, totals['bytes_written']/MB))
+    if summary['elapsed_s'] is not None:
+        print('  elapsed    {:8.2f} s, peak RSS {:.0f} MB'.format(
+              summary['elapsed_s'],summary['maxrss_MB']))
+
+
+_workdata = None # per-process working buffer, reused for every hour
+
+def hour_buffer_shape():
+    """Shape of the (variable,height,time) working buffer for one hour:
+    the raw variables in 'usevars' plus potential temperature
+    """
+    return (len(usevars)+1, len(ftlevels), sampleRateRaw*60*minutesPerFile)
+
+
+def read_hour(fpath,data,chunksize=chunksize,cachedir=cachedir,log=None):
+    """Read the raw variables in 'usevars' from hourly file 'fpath' into
+    working buffer 'data', with shape hour_buffer_shape(), and return
+    the int64 sample times
+    """
+    if log is None:
+        log = StageLog()
+    # the extra slot at the end of the buffer will hold potential temperature
+    with log.stage('read',fpath) as counts:
+        # count the bytes of the binary cache if it is used, otherwise
+        # those of the raw text file
+        readpaths = [fpath]
+        if log.enabled and (cachedir is not None):
+            _, _, datapath, timespath = _dap_cache_paths(fpath,cachedir,
+                                                         data.dtype,usevars)
+            if os.path.isfile(datapath) and os.path.isfile(timespath):
+                readpaths = [datapath, timespath]
+        times, _ = read_dap_file(fpath,out=data[:len(usevars)],
+                                 chunksize=chunksize,cachedir=cachedir,
+                                 variables=usevars)
+        counts['rows'] = len(times)
+        if log.enabled:
+            counts['bytes_read'] = sum(os.path.getsize(path) for path in readpaths)
+    return times
+
+
+def prefetch_hours(fpaths,chunksize=chunksize,dtype=dtype,cachedir=cachedir,
+                   log=None):
+    """Read the hourly files 'fpaths' in a background thread, one hour
+    ahead of the caller. Yields (fpath,raw) in order, where 'raw' is
+    the (times,data) to pass to process_hour(), or the exception raised
+    while reading the file.
+
+    The reader thread parses hour N+1 while the caller processes hour N
+    (pandas parsing and file I/O run without the GIL). Only two working
+    buffers exist, which are passed back and forth through queues, so
+    at most two hours of raw data are held; a buffer is reused as soon
+    as the caller asks for the next hour.
+    """
+    free = queue.Queue()
+    ready = queue.Queue()
+    stop = threading.Event()
+    for _ in range(2):
+        free.put(np.empty(hour_buffer_shape(),dtype=dtype))
+
+    def reader():
+        for fpath in fpaths:
+            data = free.get()
+            if stop.is_set():
+                return # the caller stopped early
+            try:
+                raw = (read_hour(fpath,data,chunksize=chunksize,
+                                 cachedir=cachedir,log=log), data)
+            except Exception as err:
+                free.put(data)
+                raw = err
+            ready.put((fpath,raw))
+        ready.put(None)
+
+    thread = threading.Thread(target=reader,daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is None:
+                break
+            yield item
+            if not isinstance(item[1],Exception):
+                free.put(item[1][1])
+    finally:
+        # unblock the reader if the caller stops early
+        stop.set()
+        free.put(None)
+        thread.join()
+
+
+def process_hour(fpath,chunksize=chunksize,dtype=dtype,cachedir=cachedir,
+                 log=None,raw=None):
+    """Read, tilt-correct and subsample the hourly raw DAP file 'fpath'.
+
+    Returns the output sample times (int64 nanoseconds since the epoch),
+    an array with shape
+    (len(mmcfields),Nz,Nt) holding the MMC data columns U, V, W, TH, P,
+    TKE, TAU11, TAU12, TAU13, TAU22, TAU23, TAU33 and HFLUX, the
+    decimation filter sums at either end of the hour (None unless
+    decimation='lowpass') and the moments of the first and last
+    averaging windows, to be joined with those of the neighboring hours
+    by stitch_hours().
+
+    The raw variables in 'usevars' plus potential temperature are held
+    in a single contiguous (variable,height,time) buffer of type
+    'dtype', and unit conversions and tilt correction are applied to it
+    in place.
+    Turbulence statistics are accumulated over windows of 'statsWindow'
+    seconds with a MomentAccumulator. Each stage is timed with 'log', a
+    StageLog, if given. If the raw file was already read by
+    prefetch_hours(), pass the result as 'raw'. This is a module-level
+    function so that hours may be processed by a pool of worker
+    processes; each process keeps its own working buffer.
+    """
+    global _workdata
+    if log is None:
+        log = StageLog()
     z = 0.3048*np.array(ftlevels)
     Nz = len(z)
-    datacolumns = pd.MultiIndex.from_product([z,varnames],names=['height',None])
     secondsPerMinute = 60
     signalRawSamples = sampleRateRaw*secondsPerMinute*minutesPerFile
     signalTargSamples = sampleRateTarg*secondsPerMinute*minutesPerFile
     sampleStride = int(sampleRateRaw/sampleRateTarg)
 
-    sampletimes = []
-
-    #declare and initialize mean arrays to zero
-    # TODO: can rewrite code without these declared arrays
-    um = np.zeros((Nz,signalTargSamples))
-    vm = np.zeros((Nz,signalTargSamples))
-    wm = np.zeros((Nz,signalTargSamples))
-    usm = np.zeros((Nz,signalTargSamples))
-    vcm = np.zeros((Nz,signalTargSamples))
-    wdm = np.zeros((Nz,signalTargSamples))
-    tsm = np.zeros((Nz,signalTargSamples))
-    tm = np.zeros((Nz,signalTargSamples))
-    thm = np.zeros((Nz,signalTargSamples))
-    pm = np.zeros((Nz,signalTargSamples))
-    rhm = np.zeros((Nz,signalTargSamples))
-    uf = np.zeros((Nz,signalTargSamples))
-    vf = np.zeros((Nz,signalTargSamples))
-    wf = np.zeros((Nz,signalTargSamples))
-    tf = np.zeros((Nz,signalTargSamples))
-    thf = np.zeros((Nz,signalTargSamples))
-    pf = np.zeros((Nz,signalTargSamples))
-    auxf = np.zeros((Nz,signalTargSamples))
-    tkem = np.zeros((Nz,signalTargSamples))
-    tau11 = np.zeros((Nz,signalTargSamples))
-    tau12 = np.zeros((Nz,signalTargSamples))
-    tau13 = np.zeros((Nz,signalTargSamples))
-    tau22 = np.zeros((Nz,signalTargSamples))
-    tau23 = np.zeros((Nz,signalTargSamples))
-    tau33 = np.zeros((Nz,signalTargSamples))
-    hflux = np.zeros((Nz,signalTargSamples)) 
- 
-    # these fields were not sampled
-    tkem[:] = dummyval
-    tau11[:] = dummyval
-    tau12[:] = dummyval
-    tau13[:] = dummyval
-    tau23[:] = dummyval
-    tau22[:] = dummyval
-    tau33[:] = dummyval
-    hflux[:] = dummyval
+    ivar = {varname: i for i,varname in enumerate(usevars + ['th'])}
+    ifld = {fieldname: i for i,fieldname in enumerate(mmcfields)}
+
+    # read data file into the (variable,height,time) buffer, unless it
+    # was already read by prefetch_hours()
+    if isinstance(raw,Exception):
+        raise raw
+    elif raw is not None:
+        datatimes, data = raw
+    else:
+        bufshape = hour_buffer_shape()
+        if _workdata is None or _workdata.shape != bufshape or _workdata.dtype != dtype:
+            _workdata = None # release the old buffer before allocating a new one
+            _workdata = np.empty(bufshape,dtype=dtype)
+        data = _workdata
+        datatimes = read_hour(fpath,data,chunksize=chunksize,cachedir=cachedir,
+                              log=log)
+    print("tStrt,tStop = {},{}".format(*datatimes[[0,-1]].view('datetime64[ns]')))
+    outputtimes = datatimes[::sampleStride].copy()
+
+    # - note: for each raw TTU u_zonal = vsonic, and v_meridional = -usonic
+    # - note: the remainder of this function assumes arrays have dimensions
+    #   (height,time); these are views into the working buffer
+    u = data[ivar['vwest']]
+    v = data[ivar['unorth']]
+    w = data[ivar['w']]
+    t = data[ivar['t']]
+    p = data[ivar['p']]
+    th = data[ivar['th']]
+
+    with log.stage('convert',fpath,rows=signalRawSamples):
+        np.negative(v,out=v)
+        convert_units(t,p,th)
+
+    ### As of 4_15_19 JAS added Branko form of tilt correction from EOL description
+    with log.stage('tilt',fpath,rows=signalRawSamples):
+        rotation,offset = tilt_correction_matrices(reg_coefs,tilts)
+        apply_tilt_correction(u,v,w,rotation,offset,chunksize=chunksize)
+
+    fields = np.empty((len(mmcfields),Nz,signalTargSamples),dtype=dtype)
+
+    # 1-Hz samples of the mean fields, labeled by the first raw sample in
+    # each window of sampleStride samples; by default, the mean over the
+    # window, for all heights at once
+    # - note: in 'point' mode, indices=[0,50,100,...,179900,179950]; the
+    #   original code used [50,100,150,...,179900,179950,179999]
+    with log.stage('decimate',fpath,rows=signalRawSamples):
+        fields[:5], edges = decimate_fields([u,v,w,th,p],sampleStride,decimation,
+                                            chunksize=chunksize)
+
+    # turbulence statistics over each statsWindow, accumulated from the
+    # raw samples one chunk at a time; each output record takes the
+    # statistics of the window it falls in
+    with log.stage('statistics',fpath,rows=signalRawSamples):
+        fields[ifld['tke']:], moments = turbulence_statistics(
+                datatimes,u,v,w,th,outputtimes,window=statsWindow,
+                chunksize=chunksize)
+
+    return outputtimes, fields, edges, moments
+
+
+def stitch_hours(results):
+    """Join consecutive hourly (times,fields,edges,moments) results from
+    process_hour(), yielding (times,fields) for each hour in order.
+
+    In 'lowpass' decimation mode, the first and last few samples of an
+    hour are filtered with data from the neighboring hours: 'edges'
+    holds the filter sums at the start and end of each hour, which are
+    added to those of the previous hour if the two are contiguous in
+    time. Likewise, if 'statsWindow' does not divide the length of a
+    file, an averaging window may be split between two hours: the
+    'moments' of the last window of an hour are then merged with those
+    of the first window of the next hour, and the turbulence statistics
+    of the records in that window are updated in both hours. Results
+    are therefore yielded one hour behind.
+    """
+    prev = None
+    for times,fields,edges,moments in results:
+        if prev is not None:
+            ptimes,pfields,pedges,pmoments = prev
+            dt = ptimes[1] - ptimes[0]
+            if (edges is not None) and (pedges is not None) \
+                    and (times[0] - ptimes[-1] == dt):
+                K = edges.shape[-1] // 2
+                joined = Decimator.ratio(pedges[1,0] + edges[0,0],
+                                         pedges[1,1] + edges[0,1])
+                pfields[:5,:,-K:] = joined[:,:,:K]
+                fields[:5,:,:K] = joined[:,:,K:]
+            if (moments is not None) and (pmoments is not None) \
+                    and (moments[0].t0 == pmoments[1].t0):
+                head = moments[0]
+                head.merge(pmoments[1])
+                for htimes,hfields in [(ptimes,pfields),(times,fields)]:
+                    inside = (head.window_index(htimes) == 0)
+                    hfields[5:,:,inside] = head.statistics(htimes[inside])
+            yield ptimes, pfields
+        prev = (times,fields,edges,moments)
+    if prev is not None:
+        yield prev[:2]
+
+
+def hours_are_joined():
+    """Whether the output of an hour depends on the neighboring hours
+    (see stitch_hours()): with lowpass decimation, or if averaging
+    windows of 'statsWindow' seconds may be split between files
+    """
+    filelength = 60*minutesPerFile*10**9
+    return (decimation == 'lowpass') \
+            or (filelength % int(round(statsWindow*1e9)) != 0)
+
+
+def TTURawToMMC(dpath,startdate,outpath,enddate=None,outformat=outformat,
+                chunksize=chunksize,nprocs=1,dtype=dtype,cachedir=cachedir,
+                stagelog=stagelog,prefetch=prefetch):
+    """Read files with 'dap_filenames' format corresponding to
+    'startdate' from 'dpath', write out MMC data to 'outpath', which
+    may be either a file path or a directory path (a default filename
+    will be generated). If 'enddate' is specified, all days from
+    'startdate' through 'enddate' are written to the same output.
+
+    With outformat='mmc', the output is in the legacy MMC ASCII
+    format; with outformat='netcdf', the same fields and header
+    metadata are written to a compressed netCDF4 file (see
+    NetCDFWriter).
+
+    Raw files are streamed 'chunksize' rows at a time into a working
+    buffer of type 'dtype' that is allocated once and reused for every
+    hour. If 'nprocs' > 1, the hourly files are processed by a pool of
+    'nprocs' worker processes; records are still written out in time
+    order. Otherwise, if 'prefetch' is True, the next hour is read in a
+    background thread while the current one is processed (see
+    prefetch_hours()). If 'cachedir' is specified, parsed raw files are cached there
+    as memory-mapped binary arrays (see cached_dap_file()). If
+    'stagelog' is specified, the wall time, rows, bytes and peak memory
+    of each stage of each hour are appended to that JSON-lines file (see
+    StageLog), and a summary is printed at the end.
+    """
+    tstart = time.perf_counter()
+    startdate = pd.to_datetime(startdate)
+    dateStr = startdate.strftime('%Y-%m-%d')
+    if enddate is None:
+        enddate = startdate
+    else:
+        enddate = pd.to_datetime(enddate)
+        dateStr += enddate.strftime(' to %Y-%m-%d')
+    print("dateStr = {:s}".format(dateStr))
 
     #Open the output file
     if os.path.isdir(outpath):
         # if we got an output directory, generate default filename and tack it
         # onto the end of the output dir path
-        outfilename = startdate.strftime('TTU200m_%Y_%m%d-1Hz.dat')
+        outfilename = default_outfilename(startdate,enddate,outformat)
         outpath = os.path.join(outpath,outfilename)
-    fout = open(outpath,'w')
-
-    #
-    # Write the MMC file-header metadata
-    #
-    fout.write(header.format(
-        institution='SNL',
-        location='TTUTOWER',
-        latitude=ttu_lat,
-        longitude=ttu_lon,
-        codename='TOWER',
-        codetype='DATA',
-        casename='DIURNAL',
-        benchmark='CASE1',
-        levels=len(z),
-    ))
-
-    ### For each hourly 50Hz file of TTU data...
-    for starttime,endtime in zip(starttimes,endtimes):
-        startdate = startdate.replace(hour=starttime)
-        # get dap filename for current start date
-        # e.g., 'tower.z01.00.20131108.000000.ttu200m.dat'
-        filename = startdate.strftime(dap_filenames)
-        fpath = os.path.join(dpath,filename)
-
-        # read data file, which is in wide format, has column headers in the 5th
-        # row (irow=4), and datetimes in the first column (icol=0). Column
-        # names have variables changing fastest, then heights, i.e.,
-        #   unorth_3ft,vwest_3ft,...,unorth_8ft,vwest_8ft,...
-        df = pd.read_csv(fpath,skiprows=5,header=None,
-                         parse_dates={'datetime':[0]})
-        df = df.set_index('datetime')
-        df.columns = datacolumns
-        df = df.reorder_levels([1,0],axis=1).sort_index(axis=1)
-        
-        # now columns have heights changing fastest
-        # - time-height data may be selected by column name
-        #   e.g., df['unorth'] has array data with shape (Nt,Nz)
-        # - note: for each raw TTU u_zonal = vsonic, and v_meridional = -usonic
-        # - note: the remainder of this function assumes arrays have dimensions (height,time)
-        u = df['vwest'].values.T
-        v = -df['unorth'].values.T
-        w = df['w'].values.T
-        us = df['ustream'].values.T
-        vc = df['vcross'].values.T
-        wd = df['wdir'].values.T
-        ts = df['tsonic'].values.T
-        t = df['t'].values.T
-        p = df['p'].values.T
-        rh = df['rh'].values.T
-
-        sampletimes += list(df.index) # append new timestamps
-        tStop = len(sampletimes)
-        tStrt = tStop - 3600*sampleRateRaw
-        print("tStrt,tStop = {:d},{:d}".format(tStrt,tStop))
-        outputtimes = sampletimes[tStrt:tStop:sampleStride]
-
-        # original code written for height-time arrays instead of height-time
-        assert u.shape == (Nz,signalRawSamples)
-
-        # unit conversions on temperature(F->K) and pressure( 1 kPa to 10 mbars)
-        t = (t - 32.)*5./9. + 273.15
-        p = 10.*p
-        R = 287.04
-        cv = 718.0
-        cp = R+cv
-        R_cp = R/cp
-        gamma = cp/cv
-        p00 = 1.0e5 #(Pa)
-        th = t * (p00 / (100.0*p))**R_cp
-
-        ### As of 4_15_19 JAS added Branko form of tilt correction from EOL description
-        u,v,w = tilt_correction(u.T,v.T,w.T,reg_coefs,tilts)
-        # - note: the remainder of this function assumes arrays have dimensions (height,time)
-        u = u.T
-        v = v.T
-        w = w.T
-
-        # TODO: replace all of this 'subSampleByMean' code with # df.rolling().mean()
-        if(subSampleByMean):# {{{
-            ufRaw = np.zeros((Nz,sampleStride))
-            vfRaw = np.zeros((Nz,sampleStride))
-            wfRaw = np.zeros((Nz,sampleStride))
-            tfRaw = np.zeros((Nz,sampleStride))
-            thfRaw = np.zeros((Nz,sampleStride))
-            pfRaw = np.zeros((Nz,sampleStride))
-            i=0
-            j=0
-            for k in range(signalRawSamples):  #For each line in the file
-                if (k%sampleStride == 0 and k > 0) or k == signalRawSamples-1:#Take the mean of the raw data over this sampleStride then compute fluctuations
-                    #Compute the means
-                    um[:,i] = np.nanmean(u[:,k-sampleStride:k],axis=1)
-                    vm[:,i] = np.nanmean(v[:,k-sampleStride:k],axis=1)
-                    wm[:,i] = np.nanmean(w[:,k-sampleStride:k],axis=1)
-                    usm[:,i] = np.nanmean(us[:,k-sampleStride:k],axis=1)
-                    vcm[:,i] = np.nanmean(vc[:,k-sampleStride:k],axis=1)
-                    wdm[:,i] = np.nanmean(wd[:,k-sampleStride:k],axis=1)
-                    tsm[:,i] = np.nanmean(ts[:,k-sampleStride:k],axis=1)
-                    tm[:,i] = np.nanmean(t[:,k-sampleStride:k],axis=1)
-                    thm[:,i] = np.nanmean(th[:,k-sampleStride:k],axis=1)
-                    pm[:,i] = np.nanmean(p[:,k-sampleStride:k],axis=1)
-                    rhm[:,i] = np.nanmean(rh[:,k-sampleStride:k],axis=1)
-                    #Compute the core variable fluctuations 
-                    for l in range(Nz):
-                        ufRaw[l,:] = np.subtract(u[l,k-sampleStride:k],um[l,i])
-                        vfRaw[l,:] = np.subtract(v[l,k-sampleStride:k],vm[l,i])
-                        wfRaw[l,:] = np.subtract(w[l,k-sampleStride:k],wm[l,i])
-                        tfRaw[l,:] = np.subtract(t[l,k-sampleStride:k],tm[l,i])
-                        thfRaw[l,:] = np.subtract(t[l,k-sampleStride:k],thm[l,i])
-                        pfRaw[l,:] = np.subtract(p[l,k-sampleStride:k],pm[l,i])
-                    uf[:,i] = np.nanmean(ufRaw,axis=1)
-                    vf[:,i] = np.nanmean(vfRaw,axis=1)
-                    wf[:,i] = np.nanmean(wfRaw,axis=1)
-                    tf[:,i] = np.nanmean(tfRaw,axis=1)
-                    thf[:,i] = np.nanmean(thfRaw,axis=1)
-                    pf[:,i] = np.nanmean(pfRaw,axis=1)
-                    #Compute the auxilliary fluctuation products
-                    tkem[:,i] = np.nanmean(np.multiply(ufRaw,ufRaw)+np.multiply(vfRaw,vfRaw)+np.multiply(wfRaw,wfRaw),axis=1)
-                    tau11[:,i] = np.nanmean(np.multiply(ufRaw,ufRaw),axis=1)
-                    tau12[:,i] = np.nanmean(np.multiply(ufRaw,vfRaw),axis=1)
-                    tau13[:,i] = np.nanmean(np.multiply(ufRaw,wfRaw),axis=1)
-                    tau23[:,i] = np.nanmean(np.multiply(vfRaw,wfRaw),axis=1)
-                    tau22[:,i] = np.nanmean(np.multiply(vfRaw,vfRaw),axis=1)
-                    tau33[:,i] = np.nanmean(np.multiply(wfRaw,wfRaw),axis=1)
-                    hflux[:,i] = np.nanmean(np.multiply(thfRaw,wfRaw),axis=1)
-                    #increment the target sample counter and reset the subfilter counter
-                    i = i + 1
-                    j = 0
-                else:
-                    j = j + 1# }}}
-
-        # To match output intervals in original code
-        # e.g., for N=180000, indices=[50,100,150,...,179900,179950,179999]
-        #selected = slice(sampleStride,signalRawSamples,sampleStride)# {{{
-        #um[:,:-1] = u[:,selected]
-        #vm[:,:-1] = v[:,selected]
-        #wm[:,:-1] = w[:,selected]
-        #usm[:,:-1] = us[:,selected]
-        #vcm[:,:-1] = vc[:,selected]
-        #wdm[:,:-1] = wd[:,selected]
-        #tsm[:,:-1] = ts[:,selected]
-        #tm[:,:-1] = t[:,selected]
-        #thm[:,:-1] = th[:,selected]
-        #pm[:,:-1] = p[:,selected]
-        #rhm[:,:-1] = rh[:,selected]
-        #um[:,-1] = u[:,-1]
-        #vm[:,-1] = v[:,-1]
-        #wm[:,-1] = w[:,-1]
-        #usm[:,-1] = us[:,-1]
-        #vcm[:,-1] = vc[:,-1]
-        #wdm[:,-1] = wd[:,-1]
-        #tsm[:,-1] = ts[:,-1]
-        #tm[:,-1] = t[:,-1]
-        #thm[:,-1] = th[:,-1]
-        #pm[:,-1] = p[:,-1]
-        #rhm[:,-1] = rh[:,-1]# }}}
-        
-        # 1-Hz output, but has a 980ms offset
-        # indices=[49,99,149,...,179999]
-        #selected = slice(sampleStride-1,signalRawSamples,sampleStride)
-
-        # 1-Hz output
-        # indices=[0,50,100,...,179900,179950]
-        # TODO: resample with pd.resample() to guarantee sampling consistency
-        selected = slice(0,signalRawSamples,sampleStride)
-        um[:,:] = u[:,selected]
-        vm[:,:] = v[:,selected]
-        wm[:,:] = w[:,selected]
-        usm[:,:] = us[:,selected]
-        vcm[:,:] = vc[:,selected]
-        wdm[:,:] = wd[:,selected]
-        tsm[:,:] = ts[:,selected]
-        tm[:,:] = t[:,selected]
-        thm[:,:] = th[:,selected]
-        pm[:,:] = p[:,selected]
-        rhm[:,:] = rh[:,selected]
-
-        #
-        # now, write all the data
-        #
-        for i in range(um.shape[1]):
-            # write record header
-            fout.write(record.format(
-                date=dateStr,
-                time=outputtimes[i].strftime(' %H:%M:%S'),
-                ustar=0.25607,
-                z0=0.1,
-                T0=dummyval,
-                qwall=dummyval,
-            ))
-            for allcols in zip(z,um[:,i],vm[:,i],wm[:,i],thm[:,i],pm[:,i],
-                               tkem[:,i], tau11[:,i], tau12[:,i], tau13[:,i],
-                               tau22[:,i], tau23[:,i], tau33[:,i], hflux[:,i]
-                              ):
-                # write data row
-                fout.write(datarow.format(*allcols))
-
-    fout.close()
+    writer = open_writer(outpath,outformat)
+
+    # get dap filenames for each hour of each day
+    # e.g., 'tower.z01.00.20131108.000000.ttu200m.dat'
+    fpaths = [
+        os.path.join(dpath,day.replace(hour=starttime).strftime(dap_filenames))
+        for day in pd.date_range(startdate,enddate,freq='D')
+        for starttime in starttimes
+    ]
+    log = StageLog(stagelog)
+    kwargs = dict(chunksize=chunksize,dtype=dtype,cachedir=cachedir,log=log)
+    pool = None
+    try:
+        if nprocs > 1:
+            pool = ProcessPoolExecutor(max_workers=nprocs)
+            results = pool.map(partial(process_hour,**kwargs), fpaths)
+        elif prefetch:
+            results = (process_hour(fpath,raw=raw,**kwargs)
+                       for fpath,raw in prefetch_hours(fpaths,**kwargs))
+        else:
+            results = (process_hour(fpath,**kwargs) for fpath in fpaths)
+
+        ### For each hourly 50Hz file of TTU data, in time order...
+        outbytes = 0
+        for fpath,(outputtimes,fields) in zip(fpaths,stitch_hours(results)):
+            with log.stage('write',fpath,rows=len(outputtimes)) as counts:
+                writer.write(outputtimes,fields)
+                if log.enabled:
+                    writer.flush()
+                    counts['bytes_written'] = os.path.getsize(outpath) - outbytes
+                    outbytes += counts['bytes_written']
+    finally:
+        # release the workers and the output file even if an hour fails
+        if pool is not None:
+            pool.shutdown()
+        writer.close()
+    print_stage_summary(log.summary(elapsed=time.perf_counter()-tstart))
+    print("Done!")
+
+
+def default_outfilename(startdate,enddate=None,outformat=outformat):
+    """Output filename for data from 'startdate' through 'enddate'"""
+    outfilename = startdate.strftime('TTU200m_%Y_%m%d')
+    if (enddate is not None) and (enddate > startdate):
+        outfilename += enddate.strftime('-%m%d')
+    outfilename += '-1Hz.nc' if outformat == 'netcdf' else '-1Hz.dat'
+    return outfilename
+
+
+def open_writer(outpath,outformat=outformat):
+    """Open an MMCWriter or NetCDFWriter for 'outpath'"""
+    z = 0.3048*np.array(ftlevels)
+    if outformat == 'netcdf':
+        return NetCDFWriter(outpath,z,**mmcheader)
+    elif outformat == 'mmc':
+        return MMCWriter(outpath,z,**mmcheader)
+    else:
+        raise ValueError("outformat should be 'mmc' or 'netcdf'")
+
+
+#==============================================================================
+# Batch conversion
+
+def _settings(dtype=dtype):
+    """Processing settings that affect the converted data; if any of
+    these change, previously converted hours are stale
+    """
+    return dict(
+        dtype=np.dtype(dtype).name,
+        usevars=list(usevars),
+        ftlevels=list(ftlevels),
+        varnames=list(varnames),
+        sampleRateRaw=sampleRateRaw,
+        sampleRateTarg=sampleRateTarg,
+        minutesPerFile=minutesPerFile,
+        decimation=decimation,
+        statsWindow=statsWindow,
+        mmcfields=list(mmcfields),
+        reg_coefs=[list(coefs) for coefs in reg_coefs],
+        tilts=[list(angles) for angles in tilts],
+    )
+
+
+def _file_identity(fpath):
+    """Size and modification time of 'fpath', or None if it is missing"""
+    try:
+        st = os.stat(fpath)
+    except FileNotFoundError:
+        return None
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _convert_hour(fpath,resultpath,**kwargs):
+    """Process one hourly file and save the output times and fields to
+    'resultpath' (.npz). Returns None on success or an error message,
+    so that one bad file does not stop a batch.
+    """
+    try:
+        outputtimes, fields, edges, moments = process_hour(fpath,**kwargs)
+    except Exception as err:
+        return '{:s}: {:s}'.format(type(err).__name__,str(err))
+    arrays = dict(times=outputtimes,fields=fields)
+    if edges is not None:
+        arrays['edges'] = edges
+    for side,accumulator in zip(['head','tail'],moments):
+        for key,value in accumulator.arrays().items():
+            arrays['{:s}_{:s}'.format(side,key)] = value
+    tmppath = resultpath + '.tmp'
+    with open(tmppath,'wb') as f:
+        np.savez(f,**arrays)
+    os.replace(tmppath,resultpath)
+    return None
+
+
+def batch_convert(dpath,startdate,enddate,outpath,statedir=None,
+                  outformat=outformat,chunksize=chunksize,nprocs=1,dtype=dtype,
+                  cachedir=cachedir,stagelog=stagelog,prefetch=prefetch):
+    """Convert every day from 'startdate' through 'enddate', writing one
+    output file per day (with default filenames) to directory 'outpath'.
+
+    Each hour is converted once and its output times and fields are
+    saved to 'statedir' (default: 'outpath'/hourly), together with a
+    manifest recording the size and modification time of the raw file
+    it came from. On subsequent runs, hours whose raw files are
+    unchanged are skipped, so an interrupted batch resumes where it left
+    off and only hours whose raw files have changed (or that previously
+    failed) are re-converted. Changing the processing settings (e.g.,
+    'reg_coefs' or 'tilts') invalidates all converted hours. A day's
+    output file is only rewritten if any of its hours were converted.
+
+    Missing or unreadable raw files are reported and skipped. Combine
+    with 'cachedir' to also skip text parsing when hours are reconverted
+    with new settings. Stages are logged to 'stagelog', and hours are
+    prefetched if 'prefetch', as in TTURawToMMC().
+    """
+    tstart = time.perf_counter()
+    startdate = pd.to_datetime(startdate)
+    enddate = pd.to_datetime(enddate)
+    if statedir is None:
+        statedir = os.path.join(outpath,'hourly')
+    os.makedirs(statedir,exist_ok=True)
+    manifestpath = os.path.join(statedir,'manifest.json')
+    manifest = {'settings': _settings(dtype), 'hours': {}}
+    if os.path.isfile(manifestpath):
+        with open(manifestpath) as f:
+            prev = json.load(f)
+        if prev['settings'] == json.loads(json.dumps(manifest['settings'])):
+            manifest = prev
+        else:
+            print('Processing settings have changed; reconverting all hours')
+
+    def save_manifest():
+        tmppath = manifestpath + '.tmp'
+        with open(tmppath,'w') as f:
+            json.dump(manifest,f,indent=1)
+        os.replace(tmppath,manifestpath)
+
+    # find hours that need to be (re)converted
+    days = pd.date_range(startdate,enddate,freq='D')
+    dayfiles = {}
+    todo = []
+    for day in days:
+        dayfiles[day] = []
+        for starttime in starttimes:
+            filename = day.replace(hour=starttime).strftime(dap_filenames)
+            fpath = os.path.join(dpath,filename)
+            ident = _file_identity(fpath)
+            if ident is None:
+                print('Skipping missing file',fpath)
+                continue
+            dayfiles[day].append(filename)
+            entry = manifest['hours'].get(filename)
+            resultpath = os.path.join(statedir,os.path.splitext(filename)[0]+'.npz')
+            if (entry is None) or (entry['raw'] != ident) \
+                    or (not os.path.isfile(resultpath)):
+                todo.append((day,filename,fpath,resultpath,ident))
+    print('Converting {:d} hourly files'.format(len(todo)))
+
+    # convert hours, updating the manifest as each one completes
+    log = StageLog(stagelog)
+    kwargs = dict(chunksize=chunksize,dtype=dtype,cachedir=cachedir,log=log)
+    pool = None
+    updated = set()
+    try:
+        if nprocs > 1:
+            pool = ProcessPoolExecutor(max_workers=nprocs)
+            errors = pool.map(partial(_convert_hour,**kwargs),
+                              [item[2] for item in todo], [item[3] for item in todo])
+        elif prefetch:
+            raws = prefetch_hours([item[2] for item in todo],**kwargs)
+            errors = (_convert_hour(item[2],item[3],raw=raw,**kwargs)
+                      for item,(_,raw) in zip(todo,raws))
+        else:
+            errors = (_convert_hour(item[2],item[3],**kwargs) for item in todo)
+        for (day,filename,fpath,resultpath,ident),err in zip(todo,errors):
+            if err is not None:
+                print('Failed to convert {:s} -- {:s}'.format(fpath,err))
+                manifest['hours'].pop(filename,None)
+            else:
+                manifest['hours'][filename] = {
+                    'raw': ident,
+                    'result': os.path.basename(resultpath),
+                }
+            save_manifest()
+            updated.add(day)
+            if hours_are_joined():
+                # the first and last hours are joined with neighboring days
+                updated.update([day - pd.Timedelta(days=1), day + pd.Timedelta(days=1)])
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    def load_hour(entry):
+        with np.load(os.path.join(statedir,entry['result'])) as result:
+            edges = result['edges'] if 'edges' in result else None
+            moments = None
+            if 'head_n' in result:
+                moments = tuple(
+                    MomentAccumulator.from_arrays(**{
+                        key: result['{:s}_{:s}'.format(side,key)]
+                        for key in ['window','t0','n','mean','comoment']})
+                    for side in ['head','tail'])
+            return result['times'], result['fields'], edges, moments
+
+    # assemble daily output files from the converted hours
+    hourspan = pd.Timedelta(minutes=minutesPerFile)
+    for day in days:
+        outfile = os.path.join(outpath,default_outfilename(day,outformat=outformat))
+        if (day not in updated) and os.path.isfile(outfile):
+            continue
+        converted = [manifest['hours'][filename] for filename in dayfiles[day]
+                     if filename in manifest['hours']]
+        if len(converted) == 0:
+            continue
+        print('Writing',outfile)
+        # hours adjacent to this day, if converted, for lowpass filtering
+        # or averaging windows across midnight
+        before = after = None
+        if hours_are_joined():
+            first = day.replace(hour=starttimes[0]) - hourspan
+            last = day.replace(hour=starttimes[-1]) + hourspan
+            before = manifest['hours'].get(first.strftime(dap_filenames))
+            after = manifest['hours'].get(last.strftime(dap_filenames))
+        entries = [entry for entry in [before] + converted + [after]
+                   if entry is not None]
+        tmpfile = outfile + '.tmp'
+        writer = open_writer(tmpfile,outformat)
+        try:
+            hours = stitch_hours(load_hour(entry) for entry in entries)
+            outbytes = 0
+            for entry,(times,fields) in zip(entries,hours):
+                if (entry is before) or (entry is after):
+                    continue
+                with log.stage('write',entry['result'],rows=len(times)) as counts:
+                    writer.write(times,fields)
+                    if log.enabled:
+                        writer.flush()
+                        counts['bytes_written'] = os.path.getsize(tmpfile) - outbytes
+                        outbytes += counts['bytes_written']
+        finally:
+            writer.close()
+        os.replace(tmpfile,outfile)
+    print_stage_summary(log.summary(elapsed=time.perf_counter()-tstart))
     print("Done!")
 
 
 #==============================================================================
 if __name__ == '__main__':
-    import sys
-    if not len(sys.argv) == 4:
-        sys.exit('USAGE: {:s} rawdatadir startdate outpath'.format(sys.argv[0]))
-    inpath, startdate, outpath = sys.argv[1:]
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Convert raw 50-Hz TTU tower data to MMC format')
+    parser.add_argument('rawdatadir')
+    parser.add_argument('startdate')
+    parser.add_argument('outpath')
+    parser.add_argument('nprocs', nargs='?', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--enddate',
+                        help='convert all days from startdate through enddate')
+    parser.add_argument('--format', dest='outformat', default=outformat,
+                        choices=['mmc','netcdf'])
+    parser.add_argument('--batch', action='store_true',
+                        help='write one output per day to the outpath directory,'
+                             ' skipping hours that were converted by a previous'
+                             ' run and whose raw files are unchanged')
+    parser.add_argument('--cachedir', default=cachedir,
+                        help='directory for memory-mapped binary copies of'
+                             ' parsed raw files')
+    parser.add_argument('--prefetch', action='store_true', default=prefetch,
+                        help='read the next hour in a background thread while'
+                             ' processing the current one')
+    parser.add_argument('--stagelog', default=stagelog,
+                        help='append per-hour, per-stage timing and memory'
+                             ' records to this JSON-lines file')
+    args = parser.parse_args()
 
-    TTURawToMMC(inpath,startdate,outpath)
+    if args.batch:
+        batch_convert(args.rawdatadir, args.startdate,
+                      args.enddate or args.startdate, args.outpath,
+                      outformat=args.outformat, nprocs=args.nprocs,
+                      cachedir=args.cachedir, stagelog=args.stagelog,
+                      prefetch=args.prefetch)
+    else:
+        TTURawToMMC(args.rawdatadir, args.startdate, args.outpath,
+                    enddate=args.enddate, outformat=args.outformat,
+                    nprocs=args.nprocs, cachedir=args.cachedir,
+                    stagelog=args.stagelog, prefetch=args.prefetch)
 
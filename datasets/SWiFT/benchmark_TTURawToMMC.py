@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+# Benchmark suite for TTURawToMMC.py
+#
+# Writes synthetic raw DAP files with the same layout as the TTU tower data
+# (5 header rows, then a timestamp and 10 variables at each of 10 levels per
+# row) and times each stage of the raw-to-MMC conversion for a range of file
+# counts and sample rates. Results are written to a JSON report so that
+# throughput can be compared between versions.
+#
+# usage: python benchmark_TTURawToMMC.py [--nfiles 1 4] [--rates 50 20] ...
+#
+import os, json, time, shutil, tempfile, platform
+import numpy as np
+import pandas as pd
+
+import TTURawToMMC as conv
+
+#==============================================================================
+# Synthetic data
+
+def synthetic_tower_data(starttime,sampleRate=conv.sampleRateRaw,
+                         minutes=conv.minutesPerFile,seed=None):
+    """Generate raw tower data for 'minutes' minutes from 'starttime' at
+    'sampleRate' Hz, in the units of the DAP files (velocities in m/s,
+    temperatures in degF, pressure in kPa, relative humidity in %).
+
+    Winds follow a log profile with red-noise turbulence (1-s
+    correlation time) of realistic intensity, the temperature
+    fluctuations are correlated with w to give a positive heat flux, and
+    pressure decreases with height. Returns the int64 sample times and
+    an array with shape (Nt,Nz,Nvar), ordered like TTURawToMMC.varnames.
+    """
+    rng = np.random.default_rng(seed)
+    Nt = int(sampleRate*60*minutes)
+    z = 0.3048*np.array(conv.ftlevels)[:,np.newaxis]
+    times = pd.Timestamp(starttime).value + np.arange(Nt)*int(1e9/sampleRate)
+
+    def red_noise(std,tau=1.0):
+        # white noise shaped to a Lorentzian spectrum with an FFT
+        f = np.fft.rfftfreq(Nt,1.0/sampleRate)
+        xhat = np.fft.rfft(rng.standard_normal((len(z),Nt)),axis=-1)
+        x = np.fft.irfft(xhat/np.sqrt(1 + (2*np.pi*f*tau)**2),n=Nt,axis=-1)
+        return std * x / x.std(axis=-1,keepdims=True)
+
+    ustar, z0 = 0.4, 0.1
+    speed = ustar/0.4 * np.log(z/z0)
+    winddir = np.radians(225.0)
+    ustream = speed + red_noise(2.4*ustar)
+    vcross = red_noise(1.9*ustar)
+    w = red_noise(1.25*ustar)
+    tK = 288.0 - 0.0065*z + red_noise(0.3) + 0.2*w
+    # wind components toward the north and west
+    unorth = -(ustream*np.cos(winddir) - vcross*np.sin(winddir))
+    vwest = ustream*np.sin(winddir) + vcross*np.cos(winddir)
+    wdir = np.mod(np.degrees(np.arctan2(vwest,-unorth)) + 180., 360.)
+    t = (tK - 273.15)*9/5 + 32
+    tsonic = t + 0.5
+    p = 90.0*np.exp(-z/8400.) + red_noise(0.002,tau=10.)
+    rh = np.clip(40.0 + red_noise(2.0,tau=10.),0,100)
+
+    columns = dict(unorth=unorth, vwest=vwest, w=w, ustream=ustream,
+                   vcross=vcross, wdir=wdir, tsonic=tsonic, t=t, p=p, rh=rh)
+    data = np.stack([columns[varname] for varname in conv.varnames],axis=-1)
+    return times, data.transpose(1,0,2)
+
+
+def write_dap_file(fpath,times,data,blocksize=10000):
+    """Write synthetic tower data, as returned by synthetic_tower_data(),
+    to 'fpath' in the raw DAP file layout
+    """
+    Nt = len(times)
+    rowfmt = '%s' + data.shape[1]*data.shape[2]*',%.3f' + '\n'
+    timestrs = np.datetime_as_string(times.view('datetime64[ns]'),unit='ms')
+    with open(fpath,'w') as f:
+        f.write('"TTU 200-m tower, sonic anemometers and met sensors"\n')
+        f.write('"synthetic data written by benchmark_TTURawToMMC.py"\n')
+        f.write('"levels [ft]",' + ','.join(str(lvl) for lvl in conv.ftlevels) + '\n')
+        f.write('"variables",' + ','.join(conv.varnames) + '\n')
+        f.write('"TIMESTAMP",' + ','.join(
+            '{:s}_{:d}ft'.format(varname,lvl)
+            for lvl in conv.ftlevels for varname in conv.varnames) + '\n')
+        for i0 in range(0,Nt,blocksize):
+            rows = data[i0:i0+blocksize].reshape(-1,data.shape[1]*data.shape[2])
+            f.write(''.join(
+                rowfmt % ((timestr.replace('T',' '),) + tuple(row))
+                for timestr,row in zip(timestrs[i0:i0+blocksize],rows)
+            ))
+
+
+def generate_dap_files(dpath,startdate,nfiles,sampleRate=conv.sampleRateRaw,
+                       minutes=conv.minutesPerFile,seed=0):
+    """Write 'nfiles' consecutive hourly synthetic DAP files starting
+    at 'startdate' to 'dpath' (existing files are kept). Returns the
+    list of file paths.
+    """
+    os.makedirs(dpath,exist_ok=True)
+    fpaths = []
+    for ifile in range(nfiles):
+        starttime = pd.Timestamp(startdate) + pd.Timedelta(hours=ifile)
+        fpath = os.path.join(dpath,starttime.strftime(conv.dap_filenames))
+        if not os.path.isfile(fpath):
+            times,data = synthetic_tower_data(starttime,sampleRate,minutes,
+                                              seed=seed+ifile)
+            write_dap_file(fpath,times,data)
+        fpaths.append(fpath)
+    return fpaths
+
+
+#==============================================================================
+# Benchmarks
+
+def stage_summary(logpath):
+    """The summary record of the single run logged to the StageLog
+    JSON-lines file 'logpath' (see TTURawToMMC.StageLog.summary())
+    """
+    with open(logpath) as f:
+        records = [json.loads(line) for line in f]
+    summaries = [record for record in records if 'summary' in record]
+    if len(summaries) != 1:
+        raise ValueError('{:s} holds {:d} runs, expected 1'.format(
+                         logpath,len(summaries)))
+    return summaries[0]
+
+
+def run_benchmark(workdir,nfiles,sampleRate,minutes=conv.minutesPerFile,
+                  outformat='mmc',chunksize=conv.chunksize,dtype=conv.dtype,
+                  nprocs=1):
+    """Time the conversion of 'nfiles' synthetic hourly files sampled at
+    'sampleRate' Hz, end to end and stage by stage (from the stage log
+    written by TTURawToMMC). Returns a dict of results.
+    """
+    conv.sampleRateRaw = sampleRate
+    conv.minutesPerFile = minutes
+    conv.starttimes = np.arange(nfiles)
+    conv.endtimes = np.mod(np.arange(1,nfiles+1), 24)
+    startdate = '2013-11-08'
+    dpath = os.path.join(workdir,'raw_{:d}Hz_{:d}min'.format(sampleRate,minutes))
+    fpaths = generate_dap_files(dpath,startdate,nfiles,sampleRate,minutes)
+    rawbytes = sum(os.path.getsize(fpath) for fpath in fpaths)
+    records = nfiles * conv.sampleRateTarg*60*minutes
+
+    ext = '.nc' if outformat == 'netcdf' else '.dat'
+    outpath = os.path.join(workdir,'output'+ext)
+    # a fresh stage log for each configuration
+    logpath = os.path.join(workdir,'stages_{:d}files_{:d}Hz_{:d}min.jsonl'.format(
+                           nfiles,sampleRate,minutes))
+    if os.path.isfile(logpath):
+        os.remove(logpath)
+    tstart = time.perf_counter()
+    conv.TTURawToMMC(dpath,startdate,outpath,outformat=outformat,
+                     chunksize=chunksize,nprocs=nprocs,dtype=dtype,
+                     stagelog=logpath)
+    total = time.perf_counter() - tstart
+    outbytes = os.path.getsize(outpath)
+    summary = stage_summary(logpath)
+
+    MB = 1024.**2
+    result = dict(
+        nfiles=nfiles, sampleRate=sampleRate, minutes=minutes,
+        outformat=outformat, chunksize=chunksize,
+        dtype=np.dtype(dtype).name, nprocs=nprocs,
+        raw_bytes=rawbytes, output_bytes=outbytes, records=records,
+        stages={},
+    )
+    # with nprocs > 1, stage times are summed over the worker processes
+    for stage,totals in summary['summary'].items():
+        result['stages'][stage] = dict(
+            seconds=totals['wall_s'],
+            raw_MB_per_s=rawbytes/MB/totals['wall_s'],
+            records_per_s=records/totals['wall_s'],
+            bytes_read=totals['bytes_read'],
+        )
+    result['stages']['write']['output_MB_per_s'] = \
+            outbytes/MB/result['stages']['write']['seconds']
+    result['total'] = dict(
+        seconds=total,
+        raw_MB_per_s=rawbytes/MB/total,
+        records_per_s=records/total,
+    )
+    result['maxrss_MB'] = summary['maxrss_MB']
+    return result
+
+
+def environment():
+    """Versions and machine information for the report"""
+    return dict(
+        python=platform.python_version(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        machine=platform.machine(),
+        processor=platform.processor(),
+        cpus=os.cpu_count(),
+        system=platform.platform(),
+    )
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Benchmark TTURawToMMC on synthetic raw tower data')
+    parser.add_argument('--nfiles', nargs='+', type=int, default=[1,4],
+                        help='numbers of hourly files to convert')
+    parser.add_argument('--rates', nargs='+', type=int, default=[50],
+                        help='raw sample rates [Hz]')
+    parser.add_argument('--minutes', type=int, default=conv.minutesPerFile,
+                        help='minutes per raw file')
+    parser.add_argument('--format', dest='outformat', default='mmc',
+                        choices=['mmc','netcdf'])
+    parser.add_argument('--chunksize', type=int, default=conv.chunksize)
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float64','float32'])
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='worker processes for the end-to-end runs')
+    parser.add_argument('--workdir',
+                        help='directory for synthetic data and output (default:'
+                             ' a temporary directory that is removed afterward)')
+    parser.add_argument('--report', default='benchmark_TTURawToMMC.json',
+                        help='path of the JSON report')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark_TTURawToMMC_')
+    report = dict(
+        created=pd.Timestamp.now().isoformat(timespec='seconds'),
+        environment=environment(),
+        results=[],
+    )
+    try:
+        for sampleRate in args.rates:
+            for nfiles in args.nfiles:
+                print('Benchmarking {:d} file(s) at {:d} Hz'.format(nfiles,sampleRate))
+                result = run_benchmark(workdir,nfiles,sampleRate,
+                                       minutes=args.minutes,
+                                       outformat=args.outformat,
+                                       chunksize=args.chunksize,
+                                       dtype=np.dtype(args.dtype),
+                                       nprocs=args.nprocs)
+                report['results'].append(result)
+                for stage in list(result['stages']) + ['total']:
+                    timing = result['total'] if stage == 'total' \
+                            else result['stages'][stage]
+                    print('  {:10s} {:8.2f} s {:9.1f} MB/s {:11.0f} records/s'.format(
+                          stage, timing['seconds'], timing['raw_MB_per_s'],
+                          timing['records_per_s']))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    with open(args.report,'w') as f:
+        json.dump(report,f,indent=1)
+    print('Wrote',args.report)
@@ -0,0 +1,352 @@
+"""
+Regression tests for TTURawToMMC (run with pytest from this directory)
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+import TTURawToMMC as conv
+from benchmark_TTURawToMMC import synthetic_tower_data, write_dap_file
+
+
+def _reference_statistics(times,u,v,w,th,window):
+    """Population (co)variances over each window, computed directly"""
+    iwin = (times - (times.min() - times.min() % window))//window
+    stats = {}
+    for i in np.unique(iwin):
+        sel = (iwin == i)
+        x = np.stack([u[:,sel],v[:,sel],w[:,sel],th[:,sel]])
+        x = x - x.mean(axis=-1,keepdims=True)
+        cov = [(x[i]*x[j]).mean(axis=-1) for i,j in conv.MomentAccumulator.pairs]
+        stats[i] = np.stack([cov[0]+cov[3]+cov[5]]+cov)
+    return stats
+
+
+def test_turbulence_statistics_with_time_glitches():
+    """A backward and a forward timestamp jump must neither drop samples
+    nor raise"""
+    Nz, Nt = 3, 2000
+    window = int(1e9)
+    times = np.int64(1383868800*10**9) + np.arange(Nt,dtype=np.int64)*20000000
+    times[700] -= 5*window   # backward jump into an earlier window
+    times[1500] += 60*window # forward jump past the last window
+    rng = np.random.default_rng(0)
+    u, v, w, th = rng.standard_normal((4,Nz,Nt))
+
+    moments = conv.MomentAccumulator(Nz,times.min(),times.max(),window=1.0)
+    step = 250
+    for i0 in range(0,Nt,step):
+        moments.update(times[i0:i0+step],u[:,i0:i0+step],v[:,i0:i0+step],
+                       w[:,i0:i0+step],th[:,i0:i0+step])
+    assert np.all(moments.n.sum(axis=1) == Nt)
+
+    stats = moments.statistics()
+    for i,expected in _reference_statistics(times,u,v,w,th,window).items():
+        np.testing.assert_allclose(stats[:,:,i],expected,rtol=1e-10,atol=1e-12)
+
+    outputtimes = times[::50]
+    result,_ = conv.turbulence_statistics(times,u,v,w,th,outputtimes,
+                                          window=1.0,chunksize=step)
+    np.testing.assert_allclose(result,moments.statistics(outputtimes))
+
+
+def test_moment_accumulator_ignores_samples_outside_windows():
+    Nz, Nt = 2, 500
+    times = np.int64(1383868800*10**9) + np.arange(Nt,dtype=np.int64)*20000000
+    moments = conv.MomentAccumulator(Nz,times[0],times[-1],window=1.0)
+    glitched = times.copy()
+    glitched[10] -= 100*10**9
+    glitched[-10] += 100*10**9
+    u = np.ones((Nz,Nt))
+    moments.update(glitched,u,u,u,u)
+    assert moments.n.sum() == Nz*(Nt-2)
+    assert np.all(np.isnan(moments.statistics(glitched[[10,-10]])))
+
+
+def test_stage_log_counts_cache_bytes(tmp_path,monkeypatch):
+    monkeypatch.setattr(conv,'minutesPerFile',1)
+    starttime = pd.Timestamp('2013-11-08')
+    fpath = str(tmp_path / starttime.strftime(conv.dap_filenames))
+    write_dap_file(fpath,*synthetic_tower_data(starttime,minutes=1,seed=0))
+    cachedir = str(tmp_path / 'cache')
+    logpath = str(tmp_path / 'stages.jsonl')
+    data = np.empty(conv.hour_buffer_shape())
+    for _ in range(2):
+        conv.read_hour(fpath,data,cachedir=cachedir,log=conv.StageLog(logpath))
+    with open(logpath) as f:
+        parsed, cached = [json.loads(line)['bytes_read'] for line in f]
+    assert parsed == os.path.getsize(fpath)
+    assert cached == sum(os.path.getsize(os.path.join(cachedir,name))
+                         for name in os.listdir(cachedir))
+
+
+def test_turbulence_statistics_with_far_off_stamps():
+    """A zeroed or far-future stamp must not blow up the window count"""
+    Nz, Nt = 2, 3000
+    times = np.int64(1383868800*10**9) + np.arange(Nt,dtype=np.int64)*20000000
+    rng = np.random.default_rng(1)
+    u, v, w, th = rng.standard_normal((4,Nz,Nt))
+    outputtimes = times[::50]
+    keep = np.ones(Nt,dtype=bool)
+    keep[[100,2000]] = False
+    expected,_ = conv.turbulence_statistics(times[keep],u[:,keep],v[:,keep],
+                                            w[:,keep],th[:,keep],outputtimes,
+                                            window=1.0)
+    glitched = times.copy()
+    glitched[100] = 0 # zeroed logger stamp
+    glitched[2000] += 2*86400*10**9 # two days ahead
+    result,_ = conv.turbulence_statistics(glitched,u,v,w,th,outputtimes,
+                                          window=1.0,chunksize=500)
+    np.testing.assert_allclose(result,expected,rtol=1e-10,atol=1e-12)
+
+
+def test_cached_dap_file_defaults(tmp_path,monkeypatch):
+    monkeypatch.setattr(conv,'minutesPerFile',1)
+    starttime = pd.Timestamp('2013-11-08')
+    fpath = str(tmp_path / starttime.strftime(conv.dap_filenames))
+    write_dap_file(fpath,*synthetic_tower_data(starttime,minutes=1,seed=0))
+    times, data = conv.cached_dap_file(fpath,str(tmp_path / 'cache'))
+    expected_times, expected = conv.read_dap_file(fpath)
+    np.testing.assert_array_equal(times,expected_times)
+    np.testing.assert_array_equal(data,expected)
+
+
+def test_stage_log_runs_are_kept_apart(tmp_path):
+    logpath = str(tmp_path / 'stages.jsonl')
+    for _ in range(2):
+        log = conv.StageLog(logpath)
+        with log.stage('read','hour.dat',rows=10):
+            pass
+        summary = log.summary()
+        assert summary['summary']['read']['calls'] == 1
+        assert summary['summary']['read']['rows'] == 10
+
+
+def test_parse_timestamps_with_mixed_precision():
+    strings = ['2013-11-08 00:00:59.980','2013-11-08 00:01:00',
+               '2013-11-08 00:01:00.020']
+    expected = np.array(['2013-11-08T00:00:59.98','2013-11-08T00:01:00',
+                         '2013-11-08T00:01:00.02'],dtype='datetime64[ns]').view(np.int64)
+    np.testing.assert_array_equal(conv.parse_timestamps(pd.Series(strings)),expected)
+    np.testing.assert_array_equal(conv.parse_timestamps(pd.Index(strings[1:])),
+                                  expected[1:])
+
+
+def test_statistics_windows_split_between_files(monkeypatch):
+    """Windows that do not divide the file length are merged across
+    consecutive files, giving the statistics of a continuous record"""
+    monkeypatch.setattr(conv,'minutesPerFile',1)
+    Nz, Nt = 2, 2*3000
+    times = np.int64(1383868800*10**9) + np.arange(Nt,dtype=np.int64)*20000000
+    rng = np.random.default_rng(2)
+    u, v, w, th = rng.standard_normal((4,Nz,Nt))
+    outputtimes = times[::50]
+    expected,_ = conv.turbulence_statistics(times,u,v,w,th,outputtimes,
+                                            window=7.0,duration=120)
+    results = []
+    for hour in [slice(0,Nt//2),slice(Nt//2,Nt)]:
+        fields = np.zeros((len(conv.mmcfields),Nz,Nt//100))
+        fields[5:],moments = conv.turbulence_statistics(
+                times[hour],u[:,hour],v[:,hour],w[:,hour],th[:,hour],
+                times[hour][::50],window=7.0)
+        results.append((times[hour][::50],fields,None,moments))
+    stitched = np.concatenate([fields for _,fields in conv.stitch_hours(results)],
+                              axis=-1)
+    np.testing.assert_allclose(stitched[5:],expected,rtol=1e-10,atol=1e-12)
+
+
+def test_statistics_window_longer_than_file():
+    times = np.arange(100,dtype=np.int64)*20000000
+    u = np.zeros((1,100))
+    with pytest.raises(ValueError):
+        conv.turbulence_statistics(times,u,u,u,u,times,window=7200.)
+
+
+def test_dap_cache_reuse_and_eviction(tmp_path,monkeypatch):
+    monkeypatch.setattr(conv,'minutesPerFile',1)
+    starttime = pd.Timestamp('2013-11-08')
+    fpaths = []
+    for i,dirname in enumerate(['a','b']):
+        # raw files with the same name in different directories
+        (tmp_path / dirname).mkdir()
+        fpath = str(tmp_path / dirname / starttime.strftime(conv.dap_filenames))
+        write_dap_file(fpath,*synthetic_tower_data(starttime,minutes=1,seed=i))
+        fpaths.append(fpath)
+    cachedir = str(tmp_path / 'cache')
+
+    def cache_files():
+        return {name: os.stat(os.path.join(cachedir,name)).st_mtime_ns
+                for name in os.listdir(cachedir)}
+
+    conv.cached_dap_file(fpaths[0],cachedir,variables=conv.usevars)
+    cached_a = set(cache_files())
+    conv.cached_dap_file(fpaths[1],cachedir,variables=conv.usevars)
+    cached = cache_files()
+    assert len(cached) == 4
+    # cache hits leave the caches of both files in place, untouched
+    for fpath in fpaths:
+        times, data = conv.cached_dap_file(fpath,cachedir,variables=conv.usevars)
+    assert cache_files() == cached
+    np.testing.assert_array_equal(data,conv.read_dap_file(fpath,variables=conv.usevars)[1])
+
+    # a modified raw file is reparsed, and only its own stale cache removed
+    st = os.stat(fpaths[0])
+    os.utime(fpaths[0],ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+    conv.cached_dap_file(fpaths[0],cachedir,variables=conv.usevars)
+    updated = cache_files()
+    assert len(updated) == 4
+    assert set(updated) & set(cached) == set(cached) - cached_a
+
+
+def _mmc_records(Nt=120,seed=0):
+    """Record times and fields, rounded as in the MMC ASCII format"""
+    Nz = len(conv.ftlevels)
+    times = pd.Timestamp('2013-11-08').value + np.arange(Nt,dtype=np.int64)*10**9
+    rng = np.random.default_rng(seed)
+    fields = np.round(100*rng.standard_normal((len(conv.mmcfields),Nz,Nt)),3)
+    fields[5:,:,:10] = conv.dummyval
+    return times, fields
+
+
+def test_mmc_reader_round_trip(tmp_path):
+    fpath = str(tmp_path / 'records.dat')
+    times, fields = _mmc_records()
+    writer = conv.open_writer(fpath,'mmc')
+    writer.write(times[:50],fields[:,:,:50])
+    writer.write(times[50:],fields[:,:,50:])
+    writer.close()
+
+    reader = conv.MMCReader(fpath)
+    assert reader.Nrec == len(times)
+    assert reader.metadata['levels'] == len(conv.ftlevels)
+    np.testing.assert_allclose(reader.z,0.3048*np.array(conv.ftlevels),atol=5e-4)
+    readtimes, readfields = reader.read()
+    np.testing.assert_array_equal(readtimes,times)
+    np.testing.assert_allclose(readfields,fields,atol=5e-4)
+
+    # time ranges include both ends, and may fall between records
+    readtimes, readfields = reader.read('2013-11-08 00:00:30','2013-11-08 00:01:10')
+    np.testing.assert_array_equal(readtimes,times[30:71])
+    np.testing.assert_allclose(readfields,fields[:,:,30:71],atol=5e-4)
+    readtimes, _ = reader.read('2013-11-08 00:00:29.5','2013-11-08 00:00:31.5')
+    np.testing.assert_array_equal(readtimes,times[30:32])
+    readtimes, _ = reader.read(end='2013-11-08 00:00:04')
+    np.testing.assert_array_equal(readtimes,times[:5])
+
+    # empty ranges
+    for start,end in [('2013-11-09',None),(None,'2013-11-07'),
+                      ('2013-11-08 00:00:10.5','2013-11-08 00:00:10.7'),
+                      ('2013-11-08 00:00:20','2013-11-08 00:00:10')]:
+        readtimes, readfields = reader.read(start,end)
+        assert len(readtimes) == 0
+        assert readfields.shape == (len(conv.mmcfields),len(conv.ftlevels),0)
+    reader.close()
+
+
+def test_mmc_reader_to_xarray(tmp_path):
+    pytest.importorskip('xarray')
+    fpath = str(tmp_path / 'records.dat')
+    times, fields = _mmc_records(Nt=20)
+    writer = conv.open_writer(fpath,'mmc')
+    writer.write(times,fields)
+    writer.close()
+    reader = conv.MMCReader(fpath)
+    ds = reader.to_xarray(start='2013-11-08 00:00:05')
+    reader.close()
+    assert ds['u'].dims == ('datetime','height')
+    np.testing.assert_array_equal(ds['datetime'].values.view(np.int64),times[5:])
+    np.testing.assert_allclose(ds['u'].values,fields[0,:,5:].T,atol=5e-4)
+    assert np.all(np.isnan(ds['tke'].values[:5]))
+    assert not np.any(np.isnan(ds['tke'].values[5:]))
+
+
+def _synthetic_hours(dpath,starttimes,monkeypatch,seed=0):
+    """Write one-minute synthetic raw files starting at the hours
+    'starttimes' of 2013-11-08 to 'dpath', and set up the converter to
+    read them
+    """
+    monkeypatch.setattr(conv,'minutesPerFile',1)
+    monkeypatch.setattr(conv,'starttimes',list(starttimes))
+    monkeypatch.setattr(conv,'endtimes',[(hour+1) % 24 for hour in starttimes])
+    os.makedirs(dpath,exist_ok=True)
+    fpaths = []
+    for i,hour in enumerate(starttimes):
+        starttime = pd.Timestamp('2013-11-08') + pd.Timedelta(hours=hour)
+        fpath = os.path.join(dpath,starttime.strftime(conv.dap_filenames))
+        write_dap_file(fpath,*synthetic_tower_data(starttime,minutes=1,seed=seed+i))
+        fpaths.append(fpath)
+    return fpaths
+
+
+def test_batch_convert_resumes(tmp_path,monkeypatch,capsys):
+    fpaths = _synthetic_hours(str(tmp_path / 'raw'),[0,1],monkeypatch)
+    outpath = str(tmp_path / 'out')
+    os.makedirs(outpath)
+    outfile = os.path.join(outpath,'TTU200m_2013_1108-1Hz.dat')
+
+    def convert(**kwargs):
+        capsys.readouterr()
+        conv.batch_convert(str(tmp_path / 'raw'),'2013-11-08','2013-11-08',
+                           outpath,**kwargs)
+        out = capsys.readouterr().out
+        return int(out.split('Converting ')[1].split()[0])
+
+    assert convert() == 2
+    with open(outfile) as f:
+        first = f.read()
+    mtime = os.stat(outfile).st_mtime_ns
+    # nothing to do for a second run
+    assert convert() == 0
+    assert os.stat(outfile).st_mtime_ns == mtime
+    # only the hour whose raw file changed is reconverted
+    st = os.stat(fpaths[1])
+    os.utime(fpaths[1],ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+    assert convert() == 1
+    with open(outfile) as f:
+        assert f.read() == first
+    # changing the settings invalidates all hours
+    assert convert(dtype=np.float32) == 2
+    assert convert(dtype=np.float32) == 0
+
+    # the output matches a conversion in one go
+    single = str(tmp_path / 'single.dat')
+    conv.TTURawToMMC(str(tmp_path / 'raw'),'2013-11-08',single)
+    with open(single) as f:
+        assert f.read() == first
+
+
+def test_lowpass_decimation_split_between_hours():
+    """Hours decimated separately and stitched match a continuous record"""
+    Nz, Nt, factor = 2, 2*3000, 50
+    times = np.int64(1383868800*10**9) + np.arange(Nt,dtype=np.int64)*20000000
+    rng = np.random.default_rng(3)
+    xs = list(rng.standard_normal((5,Nz,Nt)))
+    xs[0][1,1234] = np.nan
+    expected,_ = conv.decimate_fields(xs,factor,'lowpass',chunksize=1000)
+
+    def split_results(times):
+        results = []
+        for hour in [slice(0,Nt//2),slice(Nt//2,Nt)]:
+            fields = np.zeros((len(conv.mmcfields),Nz,Nt//2//factor))
+            fields[:5],edges = conv.decimate_fields([x[:,hour] for x in xs],factor,
+                                                    'lowpass',chunksize=1000)
+            results.append((times[hour][::factor],fields,edges,None))
+        return results
+
+    stitched = np.concatenate([fields for _,fields in
+                               conv.stitch_hours(split_results(times))],axis=-1)
+    np.testing.assert_allclose(stitched[:5],expected,rtol=1e-12,atol=1e-12)
+
+    # hours that are not contiguous are filtered separately
+    gapped = times.copy()
+    gapped[Nt//2:] += 10*10**9
+    results = split_results(gapped)
+    separate = np.concatenate([fields for _,fields,_,_ in results],axis=-1)
+    stitched = np.concatenate([fields for _,fields in conv.stitch_hours(results)],
+                              axis=-1)
+    np.testing.assert_array_equal(stitched,separate)
+    K = conv.Decimator(factor,'lowpass').overlap
+    assert not np.allclose(separate[:5,:,Nt//factor//2-K:Nt//factor//2+K],
+                           expected[:,:,Nt//factor//2-K:Nt//factor//2+K])
@@ -0,0 +1,936 @@
+"""
+Helper functions shared by the MMC studies
+
+The heavy dependencies (mmctools, windtools, scipy) are only imported
+when a function that needs them is first called, so that importing
+this module -- or one of the study-specific helpers built on top of
+it -- stays cheap in worker processes and command-line tools.
+
+Results of load_sowfa_data and load_tower_reference_spectra can be
+cached on disk by setting 'cachedir' in this module, e.g.
+
+    import assessment.studies.helpers
+    assessment.studies.helpers.cachedir = '/scratch/mmc_cache'
+
+Cached results are keyed by the input files (path, size and modification
+time) and the call arguments; remove the cache directory after changing
+the analysis code itself.
+"""
+import os, sys
+import glob
+import json
+import pickle
+import hashlib
+import inspect
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, wraps
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+
+# a2e-mmc and NREL/windtools repos, added to PYTHONPATH on first use
+# (studies with a different layout can append to this list)
+module_paths = [
+    os.path.join(os.environ['HOME'],'tools','a2e-mmc'),
+    os.path.join(os.environ['HOME'],'tools'),
+]
+
+
+# Coriolis parameter at the SWiFT site
+latitude = 33.61054 # [degrees]
+fc = 2 * ( 2*np.pi/(24.0 * 3600.0) ) * np.sin(np.deg2rad(latitude))
+
+
+# Reference date for SOWFA time (seconds since)
+tref = '2013-11-08 00:00:00'
+
+
+# On-disk cache for computed statistics and spectra
+cachedir = None # directory for cached results, or None to disable caching
+cachesize = 10*1024**3 # [bytes] least recently used results are evicted beyond this
+
+
+
+def lazy_import(name,paths=None):
+    """
+    Import a module on first use, manually adding 'paths' (default:
+    module_paths) to PYTHONPATH if needed
+    """
+    try:
+        return sys.modules[name]
+    except KeyError:
+        pass
+    if paths is None:
+        paths = module_paths
+    for module_path in paths:
+        if module_path not in sys.path:
+            sys.path.append(module_path)
+    return importlib.import_module(name)
+
+
+def _mmc():
+    return lazy_import('mmctools.helper_functions')
+
+
+def _interp1d(*args,**kwargs):
+    return lazy_import('scipy.interpolate').interp1d(*args,**kwargs)
+
+
+# ------------------------
+# Caching computed results
+# ------------------------
+
+def cached(inputs):
+    """
+    Decorator that stores the results of a loader in 'cachedir'
+
+    'inputs' is a function that takes the loader arguments and returns
+    the input files or directories; results are keyed by the path, size
+    and modification time of every input file and by the (non-default
+    and default) arguments, except 'nprocs'. Results are pickled, and
+    the least recently used ones are removed once the cache exceeds
+    'cachesize' bytes.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        @wraps(func)
+        def wrapper(*args,**kwargs):
+            if cachedir is None:
+                return func(*args,**kwargs)
+            bound = signature.bind(*args,**kwargs)
+            bound.apply_defaults()
+            arguments = {name: value for name,value in bound.arguments.items()
+                         if name != 'nprocs'}
+            key = json.dumps([func.__module__, func.__qualname__,
+                              file_identities(inputs(**bound.arguments)),
+                              _key_values(arguments)], default=str)
+            key = hashlib.md5(key.encode()).hexdigest()
+            fpath = os.path.join(cachedir,'{:s}.{:s}.pkl'.format(func.__name__,key))
+            try:
+                with open(fpath,'rb') as f:
+                    result = pickle.load(f)
+            except Exception: # missing or unreadable cache file
+                pass
+            else:
+                os.utime(fpath) # mark as recently used
+                return result
+            result = func(*args,**kwargs)
+            write_cache_file(fpath,result)
+            return result
+        return wrapper
+    return decorator
+
+
+def file_identities(paths):
+    """
+    Path, size and modification time of each of the files in 'paths'
+    (directories are walked recursively)
+    """
+    identities = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            fpaths = sorted(os.path.join(dirpath,fname)
+                            for dirpath,_,fnames in os.walk(path) for fname in fnames)
+        else:
+            fpaths = [path]
+        for fpath in fpaths:
+            st = os.stat(fpath)
+            identities.append((fpath, st.st_size, st.st_mtime_ns))
+    return identities
+
+
+def write_cache_file(fpath,result):
+    """
+    Pickle 'result' to 'fpath' and evict the least recently used cache
+    files beyond 'cachesize'
+    """
+    os.makedirs(os.path.dirname(fpath),exist_ok=True)
+    # write to a temporary file, then move it into place so that an
+    # interrupted or concurrent run never leaves a partial file behind
+    tmppath = '{:s}.{:d}.tmp'.format(fpath,os.getpid())
+    try:
+        with open(tmppath,'wb') as f:
+            pickle.dump(result,f,protocol=pickle.HIGHEST_PROTOCOL)
+    except:
+        if os.path.isfile(tmppath):
+            os.remove(tmppath)
+        raise
+    os.replace(tmppath,fpath)
+
+    entries = []
+    for cachepath in glob.glob(os.path.join(os.path.dirname(fpath),'*.pkl')):
+        try:
+            st = os.stat(cachepath)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime_ns, st.st_size, cachepath))
+    total = sum(size for _,size,_ in entries)
+    for _,size,cachepath in sorted(entries):
+        if total <= cachesize or cachepath == fpath:
+            break
+        try:
+            os.remove(cachepath)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _key_values(value):
+    if isinstance(value,dict):
+        return {name: _key_values(v) for name,v in value.items()}
+    if isinstance(value,(list,tuple,np.ndarray,pd.Index)):
+        return [_key_values(v) for v in value]
+    if isinstance(value,np.generic):
+        return value.item()
+    return value
+
+
+# ------------------
+# Loading sowfa data
+# ------------------
+
+@cached(lambda dpath,**kwargs: [os.path.join(dpath,'postProcessing/planarAverages'),
+                                 os.path.join(dpath,'postProcessing/probe1')])
+def load_sowfa_data(dpath,times,heights,interval='1h',window_size='10min',
+                    thetaname='thetav',nprocs=1):
+    """
+    Load and process data of a particular SOWFA simulation
+
+    Data loaded includes:
+    - Planar averages
+    - Virutal tower data
+    """
+    # Load planar average data
+    # ------------------------
+    fpath = os.path.join(dpath,'postProcessing/planarAverages')
+    df_pavg = reader_planar_average(fpath,thetaname)
+
+    # Calculate 10-min averages and quantities of interest
+    df_pavg_10min = df_pavg.unstack().resample('10min').mean().stack()
+    calc_QOIs(df_pavg_10min)
+
+    # Calculate hourly averages
+    df_pavg_60min = df_pavg_10min.unstack().resample('60min').mean().stack()
+
+
+    # Load virtual tower data
+    # -----------------------
+    fpath = os.path.join(dpath,'postProcessing/probe1')
+    df_prob = reader_probe(fpath,thetaname)
+    df_prob['wspd'], df_prob['wdir'] = _mmc().calc_wind(df_prob)
+
+    # Calculate 10-min statistics and quantities of interest
+    df_prob_10min = calc_stats(df_prob,thetaname=thetaname)
+    calc_QOIs(df_prob_10min)
+
+    # Calculate hourly averages
+    df_prob_60min = df_prob_10min.unstack().resample('60min').mean().stack()
+
+    # Calculate frequency spectrum
+    df_prob_hgts = interpolate_to_heights(df_prob,heights)
+    df_prob_hgts = reindex_if_needed(df_prob_hgts)
+    df_prob_spectra = calc_spectra(df_prob_hgts,times,heights,interval,window_size,nprocs)
+
+
+    return df_prob_10min, df_prob_60min, df_prob_spectra, df_pavg_10min, df_pavg_60min
+
+
+def reader_probe(fpath,thetaname='thetav'):
+    """
+    Read sowfa probe file and convert to standard pandas dataframe
+    """
+    # Read in virtual tower data and convert to pandas DataFrame
+    probes = lazy_import('windtools.SOWFA6.postProcessing.probes')
+    df = probes.Probe(fpath).to_pandas()
+
+    # Convert time in seconds to datetime
+    df.reset_index(inplace=True)
+    df['t'] = pd.to_timedelta(df['t'],unit='s') + pd.to_datetime(tref)
+
+    # Rename columns
+    df.columns = ['datetime', 'height', 'u', 'v', 'w', thetaname]
+
+    # Set multi-index with levels datetime and height
+    df.set_index(['datetime','height'],inplace=True)
+    return df
+
+
+def reader_planar_average(fpath,thetaname='thetav'):
+    """
+    Read sowfa planar average file and convert to standard pandas dataframe
+    """
+    # Read in planar average data and convert to pandas DataFrame
+    averaging = lazy_import('windtools.SOWFA6.postProcessing.averaging')
+    df = averaging.PlanarAverages(fpath,varList=['U','UU','T']).to_pandas()
+
+    # Convert time in seconds to datetime
+    df.reset_index(inplace=True)
+    df['t'] = pd.to_timedelta(df['t'],unit='s') + pd.to_datetime(tref)
+
+    # Rename columns
+    df.columns = ['datetime', 'height', 'u', 'v', 'w', 'uu', 'uv', 'uw', 'vv', 'vw', 'ww', thetaname]
+
+    # Set multi-index with levels datetime and height
+    df.set_index(['datetime','height'],inplace=True)
+    return df
+
+
+def reader_source_history(fpath):
+    """
+    Read sowfa source history file and convert to standard pandas dataframe
+    """
+    # Read in source history data and convert to pandas DataFrame
+    sourceHistory = lazy_import('windtools.SOWFA6.postProcessing.sourceHistory')
+    df = sourceHistory.SourceHistory(fpath).to_pandas()
+
+    # Convert time in seconds to datetime
+    df.reset_index(inplace=True)
+    df['t'] = pd.to_timedelta(df['t'],unit='s') + pd.to_datetime(tref)
+
+    # Rename columns
+    df.columns = ['datetime', 'height', 'Fu', 'Fv', 'Fw', 'Ft']
+
+    # Set multi-index with levels datetime and height
+    df.set_index(['datetime','height'],inplace=True)
+    return df
+
+
+def load_sowfa_input_file(fpath,thetaname='thetav',check_heights=False):
+    """
+    Load a specific SOWFA input file
+
+    If 'check_heights', assert that the temperature and momentum source
+    heights are the same
+    """
+    f = lazy_import('windtools.openfoam').InputFile(fpath)
+
+    if check_heights:
+        assert np.all(np.array(f['sourceHeightsMomentum'])
+                      == np.array(f['sourceHeightsTemperature']))
+    srcMomX = np.array(f['sourceTableMomentumX'])
+    srcMomY = np.array(f['sourceTableMomentumY'])
+    srcMomZ = np.array(f['sourceTableMomentumZ'])
+    srcTemp = np.array(f['sourceTableTemperature'])
+
+    # Cast data to pandas dataframe
+    dflist = []
+    for i in range(srcMomX[:,0].size):
+        data = {}
+        data['height'] = f['sourceHeightsMomentum']
+        data['u'] = srcMomX[i,1:]
+        data['v'] = srcMomY[i,1:]
+        data['w'] = srcMomZ[i,1:]
+        data[thetaname] = srcTemp[i,1:]
+        df = pd.DataFrame(data=data)
+        df['t'] = srcMomX[i,0]
+        dflist.append(df)
+    df = pd.concat(dflist)
+
+    # Convert time in seconds to datetime
+    df['t'] = pd.to_timedelta(df['t'],unit='s') + pd.to_datetime(tref)
+
+    df['t'] = df['t'].dt.round('10min')
+
+    # Convert to standard names
+    df.rename({'t':'datetime'},axis='columns',inplace=True)
+
+    # Set multi-index with levels datetime and height
+    df.set_index(['datetime','height'],inplace=True)
+    return df
+
+
+# ----------------------
+# Loading reference data
+# ----------------------
+
+def load_radar_reference_data(fpath):
+    """
+    Load TTU radar reference data
+    """
+    radar = pd.read_csv(fpath,parse_dates=True,index_col=['datetime','height'])
+    # Extract scan types 0 and 1
+    radar_scan0 = radar.loc[radar['scan_type']==0].copy()
+    radar_scan1 = radar.loc[radar['scan_type']==1].copy()
+
+    return radar_scan0, radar_scan1
+
+
+@cached(lambda fpath,**kwargs: [fpath])
+def load_tower_reference_spectra(fpath,times,heights,interval,window_size,
+                                 thetaname='thetav',nprocs=1):
+    """
+    Load TTU tower 1-Hz data and compute spectra
+    """
+    mmc = _mmc()
+    # Load data
+    tower = pd.read_csv(fpath,parse_dates=True,index_col=['datetime','height'])
+    # Calculate some QoI
+    tower['wspd'], tower['wdir'] = mmc.calc_wind(tower)
+    tower[thetaname] = mmc.theta(tower['Ts'],tower['p'])
+    # Interpolate data to specified heights
+    tower_hgt = interpolate_to_heights(tower,heights)
+    # Reindex if needed
+    tower_hgt = reindex_if_needed(tower_hgt)
+    # Compute spectra
+    tower_spectra = calc_spectra(tower_hgt,times,heights,interval,window_size,nprocs)
+    return tower_spectra
+
+
+# --------------------------
+# Dense time-height arrays
+# --------------------------
+
+def to_dense(df):
+    """
+    Cast a dataframe with a (datetime, height) index to a dense array
+
+    Returns the sorted unique times and heights, and the data as an
+    array of shape (Ntimes, Nheights, Ncolumns) with NaN for missing
+    records
+    """
+    index = df.index.remove_unused_levels()
+    times, tcodes = _sorted_level(index.levels[0],index.codes[0])
+    heights, zcodes = _sorted_level(index.levels[1],index.codes[1])
+    shape = (len(times),len(heights),len(df.columns))
+    flat = np.asarray(tcodes)*shape[1] + zcodes
+    if len(flat) == shape[0]*shape[1] and np.all(flat[1:] > flat[:-1]):
+        # complete records, already sorted by time and height
+        values = df.to_numpy(dtype=float).reshape(shape)
+    else:
+        values = np.full(shape,np.nan)
+        values[tcodes,zcodes,:] = df.to_numpy(dtype=float)
+    return times, heights.values, values
+
+
+def from_dense(times,heights,values,columns,dropna=False):
+    """
+    Cast a dense (Ntimes, Nheights, Ncolumns) array back to a dataframe
+    with a (datetime, height) index. Records without any data are kept
+    as NaN rows, unless 'dropna' is set.
+    """
+    index = pd.MultiIndex.from_product([times,heights],names=['datetime','height'])
+    values = values.reshape(len(index),len(columns))
+    if dropna:
+        have_data = ~np.all(np.isnan(values),axis=1)
+        if not np.all(have_data):
+            index = index[have_data]
+            values = values[have_data]
+    return pd.DataFrame(values,index=index,columns=columns)
+
+
+def _sorted_level(level,codes):
+    if level.is_monotonic_increasing:
+        return level, codes
+    order = level.argsort()
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return level[order], rank[codes]
+
+
+# -------------------------------------------------
+# Calculating statistics and quantities of interest
+# -------------------------------------------------
+
+def calc_stats(df,offset='10min',thetaname='thetav',dropna=False):
+    """
+    Calculate statistics for a given data frame
+    and return a new dataframe
+
+    Window means, variances ('uu','vv','ww') and covariances ('uv','vw',
+    'uw','thetaw') are accumulated for all heights in a single pass. The
+    updates are the same as in pandas' resample().mean() and
+    resample().var(), so results are identical to resampling each field
+    separately. As with resample(), windows without samples (e.g., in a
+    data gap) are kept as NaN rows, unless 'dropna' is set.
+    """
+    times, heights, values = to_dense(df)
+    columns = list(df.columns)
+    iu, iv, iw, ith = [columns.index(name) for name in ['u','v','w',thetaname]]
+    labels, windows = window_samples(times,values,offset)
+    pairs = [(iu,iv), (iv,iw), (iu,iw), (ith,iw)]
+    products = np.stack([windows[...,i]*windows[...,j] for i,j in pairs],axis=-1)
+    velocities = windows[...,[iu,iv,iw]]
+
+    # running sums of the fields and of the products needed for the
+    # covariances, and running variances of the velocity components
+    sums = [_RunningSum(windows.shape[1:]), _RunningSum(products.shape[1:])]
+    variances = _RunningVariance(velocities.shape[1:])
+    for k in range(len(windows)):
+        sums[0].add(windows[k])
+        sums[1].add(products[k])
+        variances.add(velocities[k])
+
+    means, productmeans = [runsum.mean() for runsum in sums]
+    covariances = [productmeans[...,k] - means[...,i]*means[...,j]
+                   for k,(i,j) in enumerate(pairs)]
+    stats = np.concatenate([means, variances.variance(),
+                            np.stack(covariances,axis=-1)],axis=-1)
+    return from_dense(labels,heights,stats,
+                      columns+['uu','vv','ww','uv','vw','uw','thetaw'],dropna)
+
+
+class _RunningSum(object):
+    """
+    Kahan-compensated sums that skip NaN, updated in the same way as
+    pandas' groupby/resample means
+    """
+    def __init__(self,shape):
+        self.count = np.zeros(shape)
+        self.total = np.zeros(shape)
+        self.compensation = np.zeros(shape)
+
+    def add(self,x):
+        y = x - self.compensation
+        t = self.total + y
+        if np.isfinite(x).all():
+            self.count += 1
+            np.subtract(t,self.total,out=self.compensation)
+            self.compensation -= y
+            self.total = t
+        else:
+            valid = ~np.isnan(x)
+            self.count += valid
+            compensation = (t - self.total) - y
+            compensation[np.isnan(compensation)] = 0
+            np.copyto(self.compensation,compensation,where=valid)
+            np.copyto(self.total,t,where=valid)
+
+    def mean(self):
+        with np.errstate(invalid='ignore'):
+            return np.where(self.count > 0, self.total/self.count, np.nan)
+
+
+class _RunningVariance(object):
+    """
+    Welford updates of the sample variance (ddof=1) that skip NaN, as in
+    pandas' groupby/resample variances
+    """
+    def __init__(self,shape):
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.sqdev = np.zeros(shape)
+
+    def add(self,x):
+        delta = x - self.mean
+        if np.isfinite(x).all():
+            self.count += 1
+            self.mean += delta/self.count
+            self.sqdev += (x - self.mean)*delta
+        else:
+            valid = ~np.isnan(x)
+            self.count += valid
+            np.copyto(self.mean,self.mean + delta/np.maximum(self.count,1),where=valid)
+            np.copyto(self.sqdev,self.sqdev + (x - self.mean)*delta,where=valid)
+
+    def variance(self):
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return np.where(self.count > 1, self.sqdev/(self.count-1), np.nan)
+
+
+def window_samples(times,values,offset):
+    """
+    Group the samples of a dense (Ntimes, ...) array into the time
+    windows used by pandas' resample(offset)
+
+    Returns the window labels and the samples as an array of shape
+    (Nsamples, Nwindows, ...), padded with NaN where a window holds
+    fewer samples than the fullest one
+    """
+    freq = pd.to_timedelta(offset)
+    origin = times[0].normalize()
+    bins = np.asarray((times - origin) // freq)
+    first = bins[0]
+    bins -= first
+    nbins = bins[-1] + 1
+    labels = pd.date_range(origin + first*freq,periods=nbins,freq=freq,
+                           name='datetime').astype(times.dtype)
+    # position of each sample within its window
+    pos = np.arange(len(bins)) - np.searchsorted(bins,bins)
+    nsamples = pos.max() + 1
+    if len(bins) == nbins*nsamples:
+        # all windows are full
+        windows = values.reshape((nbins,nsamples)+values.shape[1:]).swapaxes(0,1)
+    else:
+        windows = np.full((nsamples,nbins)+values.shape[1:],np.nan)
+        windows[pos,bins] = values
+    return labels, windows
+
+
+def calc_QOIs(df):
+    """
+    Calculate derived quantities (IN PLACE)
+    """
+    df['wspd'],df['wdir'] = _mmc().calc_wind(df)
+    df['u*'] = (df['uw']**2 + df['vw']**2)**0.25
+    df['TKE'] = 0.5*(df['uu'] + df['vv'] + df['ww'])
+    ang = np.arctan2(df['v'],df['u'])
+    df['TI'] = df['uu']*np.cos(ang)**2 + 2*df['uv']*np.sin(ang)*np.cos(ang) + df['vv']*np.sin(ang)**2
+    df['TI'] = np.sqrt(df['TI']) / df['wspd']
+
+
+def calc_grad(df):
+    """
+    Calculate vertical gradient of specified field
+    """
+    # calculate at midpoints
+    tv = df.unstack(level='datetime')
+    dz = pd.Series(tv.reset_index()['height'].diff().values, index=tv.index) # dz and tv should have matching indices
+    tvgrad = tv.diff().divide(dz,axis=0)
+
+    # interpolate from midpoints back to original heights, for compatibility with original dataframe
+    zorig = dz.index.values
+    zmid = dz.index.values - dz/2
+    tvgrad = tvgrad.set_index(zmid) # first index and row are NaN
+    interpfun = _interp1d(tvgrad.index, tvgrad, axis=0, bounds_error=False, fill_value=np.nan)
+    for zi in zorig[:-1]:
+        tvgrad.loc[zi] = interpfun(zi)
+    zmid = zmid.values
+    tvgrad.loc[zorig[0]] = tvgrad.loc[zmid[1]] # nearest values: second row (first row is NaN)
+    tvgrad.loc[zorig[-1]] = tvgrad.loc[zmid[-1]] # nearest values: last row
+    tvgrad = tvgrad.loc[zorig]
+
+    tvgrad.index.name = 'height'
+    tvgrad = tvgrad.stack().reorder_levels(order=['datetime','height']).sort_index()
+    return tvgrad
+
+
+# ------------------------------
+# Calculating turbulence spectra
+# ------------------------------
+
+def interpolate_to_heights(df,heights,dropna=False):
+    """
+    Interpolate data in dataframe to specified heights
+    and return a new dataframe
+
+    Data are linearly interpolated (or extrapolated) between the two
+    neighbouring heights, as with scipy's interp1d, for all times and
+    fields at once. Times without data at the neighbouring heights give
+    NaN rows, which are dropped if 'dropna' is set.
+    """
+    times, z, values = to_dense(df)
+    heights = np.sort(np.asarray(heights))
+    heights = heights.astype(np.result_type(z,heights))
+    lower, upper, dz, dh = interpolation_stencil(z,heights)
+    # same operations as interp1d, so that results are identical
+    ylo = values[:,lower,:]
+    slope = (values[:,upper,:] - ylo) / dz[:,np.newaxis]
+    values = slope*dh[:,np.newaxis] + ylo
+    return from_dense(times,heights,values,df.columns,dropna)
+
+
+def interpolation_stencil(z,heights):
+    """
+    Compute the linear interpolation stencil from sorted heights z to
+    the specified heights
+
+    Returns the indices of the lower and upper neighbours (the outer
+    intervals are used to extrapolate), the spacing between them and
+    the distance from the lower neighbour
+    """
+    upper = np.clip(np.searchsorted(z,heights),1,len(z)-1)
+    lower = upper - 1
+    return lower, upper, z[upper]-z[lower], heights-z[lower]
+
+
+def reindex_if_needed(df,dt=None):
+    """
+    Check whether timestamps are equidistant with step dt (in seconds). If dt is not
+    specified,  dt is equal to the minimal timestep in the dataframe. If timestamps
+    are not equidistant, interpolate to equidistant time grid with step dt.
+
+    Gaps are filled by linear interpolation in time, as with pandas'
+    interpolate(method='index'), working on a dense (time, height, field)
+    array rather than on the unstacked dataframe.
+    """
+    times = _used_level(df.index,0)
+    dts = np.diff(times.values)/pd.to_timedelta(1,'s')
+
+    # If dt not specified, take dt as the minimal timestep
+    if dt is None:
+        dt = np.min(dts)
+
+    if not np.allclose(dts,dt):
+        # df is missing some timestamps, which will cause a problem when computing spectra.
+        # therefore, we first reindex the dataframe
+        start = df.index.levels[0][0]
+        end   = df.index.levels[0][-1]
+        new_index = pd.date_range(start,end,freq=pd.to_timedelta(dt,'s'),name='datetime')
+        times, heights, values = to_dense(df)
+        # samples that fall on the new time grid; all others are dropped
+        inew = new_index.get_indexer(times)
+        onGrid = inew >= 0
+        gridded = np.full((len(new_index),)+values.shape[1:],np.nan)
+        gridded[inew[onGrid]] = values[onGrid]
+        fill_gaps(new_index.asi8,gridded)
+        return from_dense(new_index,heights,gridded,df.columns)
+    else:
+        return df
+
+
+def fill_gaps(x,values):
+    """
+    Linearly interpolate NaN in a (Ntimes, ...) array along the first
+    axis (IN PLACE), at positions x
+
+    As in pandas' interpolate(method='index'), leading NaN are kept and
+    trailing NaN take the last valid value.
+    """
+    flat = values.reshape(len(x),-1)
+    missing = np.isnan(flat)
+    missingRows = np.all(missing,axis=1)
+    x = x.astype(np.float64)
+    if np.array_equal(missing.any(axis=1),missingRows):
+        # whole samples are missing: interpolate all columns at once
+        ivalid = np.flatnonzero(~missingRows)
+        if len(ivalid) == 0:
+            # no valid samples at all: leave everything as NaN
+            return
+        igap = np.flatnonzero(missingRows)
+        igap = igap[igap > ivalid[0]]
+        upper = np.minimum(np.searchsorted(ivalid,igap),len(ivalid)-1)
+        lower = np.maximum(upper-1,0)
+        ilo, ihi = ivalid[lower], ivalid[upper]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            slope = (flat[ihi] - flat[ilo]) / (x[ihi] - x[ilo])[:,np.newaxis]
+            filled = slope*(x[igap] - x[ilo])[:,np.newaxis] + flat[ilo]
+        # past the last valid sample, np.interp holds the last value
+        past = igap > ivalid[-1]
+        filled[past] = flat[ivalid[-1]]
+        flat[igap] = filled
+    else:
+        for j in range(flat.shape[1]):
+            valid = ~missing[:,j]
+            if valid.all() or not valid.any():
+                continue
+            invalid = missing[:,j].copy()
+            invalid[:np.argmax(valid)] = False # leading NaN
+            flat[invalid,j] = np.interp(x[invalid],x[valid],flat[valid,j])
+    if not np.shares_memory(flat,values):
+        values[...] = flat.reshape(values.shape)
+
+
+def _used_level(index,level):
+    """Sorted values of a MultiIndex level that are actually used"""
+    used = np.zeros(len(index.levels[level]),dtype=bool)
+    used[index.codes[level]] = True
+    values = index.levels[level][used]
+    return values if values.is_monotonic_increasing else values.sort_values()
+
+
+def calc_spectra(df,times,heights,interval,window_size,nprocs=1):
+    """
+    Calculate spectra for a given number of times and heights
+    and return a new dataframe
+
+    Power spectral densities are estimated as in mmctools'
+    power_spectral_density (Welch's method with a Hann window, linear
+    detrending and half-overlapping segments of length window_size),
+    batched over all start times and fields at each height. If 'nprocs'
+    > 1, these batches are computed by a pool of 'nprocs' worker
+    processes that read the data from shared memory; results do not
+    depend on 'nprocs'.
+    """
+    tstarts = pd.DatetimeIndex([pd.to_datetime(tstart) for tstart in times]).sort_values()
+    heights = np.sort(np.asarray(heights))
+    alltimes, z, values = to_dense(df)
+    iz = pd.Index(z).get_indexer(heights)
+    if np.any(iz < 0):
+        raise KeyError('Heights not found: {}'.format(heights[iz < 0]))
+    values = values[:,iz,:]
+
+    # Group intervals that can be stacked into one array
+    groups = {}
+    for itime,tstart in enumerate(tstarts):
+        # samples within [tstart, tstart+interval], as in mmctools
+        i0 = alltimes.searchsorted(tstart,side='left')
+        i1 = alltimes.searchsorted(tstart+pd.to_timedelta(interval),side='right')
+        dts = np.diff(alltimes[i0:i1])/pd.to_timedelta(1,'s')
+        dt = dts[0]
+        assert(np.allclose(dts,dt)),\
+            'Timestamps must be spaced equidistantly'
+        groups.setdefault((i1-i0,dt),[]).append((itime,i0))
+
+    # Split each group into tasks per height (and per block of start
+    # times when running in parallel)
+    tasks = []
+    for igroup,((nsamples,dt),group) in enumerate(groups.items()):
+        nperseg = int( pd.to_timedelta(window_size)/pd.to_timedelta(dt,'s') )
+        for block in np.array_split(np.arange(len(group)),min(nprocs,len(group))):
+            i0s = [group[i][1] for i in block]
+            for k in range(len(heights)):
+                tasks.append((igroup,block,k,(i0s,k,nsamples,dt,nperseg)))
+
+    if nprocs > 1:
+        results = _parallel_welch(values,[task[-1] for task in tasks],nprocs)
+    else:
+        results = [welch_batch(values,*task[-1]) for task in tasks]
+
+    # Merge results in task order
+    spectra = [None] * len(groups)
+    for (igroup,block,k,_),(f,P) in zip(tasks,results):
+        if spectra[igroup] is None:
+            ntimes = len(list(groups.values())[igroup])
+            spectra[igroup] = (f, np.empty((ntimes,len(heights))+P.shape[1:]))
+        spectra[igroup][1][block,k] = P
+
+    dflist = []
+    for group,(f,P) in zip(groups.values(),spectra):
+        itimes = [itime for itime,_ in group]
+        index = pd.MultiIndex.from_product([tstarts[itimes],heights,f],
+                                           names=['datetime','height','frequency'])
+        dflist.append(pd.DataFrame(P.reshape(-1,len(df.columns)),index=index,columns=df.columns))
+    if len(dflist) == 1:
+        return dflist[0]
+    return pd.concat(dflist).sort_index()
+
+
+def welch_batch(values,i0s,k,nsamples,dt,nperseg):
+    """
+    Welch spectra of all fields at height index k of a dense
+    (Ntimes, Nheights, Nfields) array, for the intervals of 'nsamples'
+    samples starting at each of the time indices 'i0s'
+
+    Returns the frequencies and an array of shape
+    (len(i0s), Nfrequencies, Nfields)
+    """
+    welch = lazy_import('scipy.signal').welch
+    samples = np.stack([values[i0:i0+nsamples,k] for i0 in i0s])
+    return welch(samples,fs=1./dt,window='hann',nperseg=nperseg,
+                 detrend='linear',scaling='density',axis=1)
+
+
+def _parallel_welch(values,tasks,nprocs):
+    """Run welch_batch tasks on a process pool, sharing 'values'"""
+    shm = shared_memory.SharedMemory(create=True,size=values.nbytes)
+    try:
+        shared = np.ndarray(values.shape,dtype=values.dtype,buffer=shm.buf)
+        shared[...] = values
+        del shared
+        worker = partial(_shared_welch_batch,shm.name,values.shape,values.dtype.str)
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            return list(pool.map(worker,*zip(*tasks)))
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _shared_welch_batch(name,shape,dtype,*args):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        values = np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+        result = welch_batch(values,*args)
+        del values
+        return result
+    finally:
+        shm.close()
+
+
+# -------------------------------------
+# Calculating rotor-averaged quantities
+# -------------------------------------
+
+def calc_rotor_average(df,zhub,diameter):
+    """
+    Calculate rotor-averaged quantities
+    and return a new dataframe
+    """
+    zlow  = zhub - diameter/2.
+    zhigh = zhub + diameter/2.
+
+    data = df.unstack()
+    heights = df.index.get_level_values(1).unique()
+    dfout = {}
+    for field in df.columns:
+        dfout[field] = np.mean(_interp1d(heights,data[field].values,axis=1,fill_value='extrapolate')(np.linspace(zlow,zhigh,21)),axis=1)
+
+    dfout['alpha'] = calc_alpha(heights,data['wspd'].values,zhub,diameter)
+    dfout['psi']   = calc_psi(heights,data['wdir'].values,zhub,diameter)
+    return pd.DataFrame(dfout,index=data.index)
+
+
+def calc_alpha(z,S,zh,D,ax=-1):
+    '''
+    Compute wind shear exponent by fitting a power law to
+    the velocity profile over the rotor disk region
+
+    Parameters
+    ----------
+    z: numpy 1D array of Nz
+        heights
+    S: numpy nD array
+        wind speed [m/s]
+    zh,D: float
+        hub height and radius of rotor disk
+    ax: int
+        axis corresponding to the vertical direction
+        default: last axis
+
+    Returns
+    -------
+    alpha: numpy nD-1 array
+        wind shear exponent
+    '''
+    optimize = lazy_import('scipy.optimize')
+    z1 = zh - D/2.
+    z2 = zh + D/2.
+    zcc = np.linspace(z1,z2,10)
+
+    #Move specified ax to last position, then reshape to 2d array and iterate
+    Nz = S.shape[ax]
+    N  = int(S.size/Nz)
+    new_shape = np.moveaxis(S,ax,-1).shape[:-1]
+    alpha = np.zeros((N))
+    for i in range(N):
+        Sint = _interp1d(z,np.moveaxis(S,ax,-1).reshape(N,Nz)[i,:],fill_value='extrapolate')(zcc)
+        Shub = _interp1d(z,np.moveaxis(S,ax,-1).reshape(N,Nz)[i,:],fill_value='extrapolate')(zh)
+
+        f = lambda x, alpha: Shub*(x/zh)**alpha
+        popt,_ = optimize.curve_fit(f,zcc,Sint,1.0)
+        alpha[i] = popt[0]
+    return alpha.reshape(new_shape)
+
+
+def calc_psi(z,WD,zh,D,ax=-1):
+    '''
+    Compute wind veer by fitting a line to
+    the wind direction profile over the rotor disk region
+
+    Parameters
+    ----------
+    z: numpy 1D array of Nz
+        heights
+    WD: numpy nD array
+        wind direction [degrees]
+    zh,D: float
+        hub height and radius of rotor disk
+    ax: int
+        average wind veer over the rotor disk
+        default: last axis
+
+    Returns
+    -------
+    psi: numpy nD-1 array
+        average wind veer over the rotor disk
+    '''
+    optimize = lazy_import('scipy.optimize')
+    z1 = zh - D/2.
+    z2 = zh + D/2.
+    zcc = np.linspace(z1,z2,10)
+
+    #Move specified ax to last position, then reshape to 2d array and iterate
+    Nz = WD.shape[ax]
+    N  = int(WD.size/Nz)
+    new_shape = np.moveaxis(WD,ax,-1).shape[:-1]
+    psi = np.zeros((N))
+    for i in range(N):
+        WDint = _interp1d(z,np.moveaxis(WD,ax,-1).reshape(N,Nz)[i,:],fill_value='extrapolate')(zcc)
+        WDhub = _interp1d(z,np.moveaxis(WD,ax,-1).reshape(N,Nz)[i,:],fill_value='extrapolate')(zh)
+
+        f = lambda x, *p: p[0]*x + p[1]
+        popt,_ = optimize.curve_fit(f,zcc-zh,WDint-WDhub,[1.0,0.0])
+        psi[i] = popt[0]
+    return psi.reshape(new_shape)
@@ -0,0 +1,110 @@
+"""
+Regression tests for the shared study helpers (run with pytest from
+this directory)
+"""
+import os
+import numpy as np
+import pandas as pd
+
+import helpers
+
+
+def _tower_data(hours=1,heights=(10.,40.,80.,120.),seed=0):
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2013-11-08 12:00',periods=hours*3600,freq='1s',name='datetime')
+    index = pd.MultiIndex.from_product([times,heights],names=['datetime','height'])
+    n = len(index)
+    return pd.DataFrame({'u': 8+rng.standard_normal(n),
+                         'v': 2+rng.standard_normal(n),
+                         'w': 0.3*rng.standard_normal(n),
+                         'thetav': 300+rng.standard_normal(n)},index=index)
+
+
+def test_interpolate_to_heights_keeps_times_without_data():
+    df = _tower_data()
+    times = df.index.levels[0]
+    df.loc[times[100]] = np.nan
+    df = df.drop(times[200],level='datetime')
+    out = helpers.interpolate_to_heights(df,[20.,100.])
+    assert len(out) == (len(times)-1)*2
+    assert out.loc[times[100]].isna().all().all()
+    dropped = helpers.interpolate_to_heights(df,[20.,100.],dropna=True)
+    assert len(dropped) == (len(times)-2)*2
+
+
+def test_calc_stats_matches_resample_across_data_gap():
+    df = _tower_data(hours=3)
+    times = df.index.levels[0]
+    gap = (times >= '2013-11-08 13:00') & (times < '2013-11-08 13:30')
+    df = df.drop(times[gap],level='datetime')
+    stats = helpers.calc_stats(df)
+
+    # windows in the gap are kept, as with resample()
+    assert len(stats) == 18*4
+    assert stats.loc['2013-11-08 13:10'].isna().all().all()
+    assert len(helpers.calc_stats(df,dropna=True)) == 15*4
+
+    unstacked = df.unstack()
+    expected = unstacked.resample('10min').mean().stack()
+    for name in ['u','v','w']:
+        expected[name*2] = unstacked[name].resample('10min').var().stack()
+    for a,b,name in [('u','v','uv'),('v','w','vw'),('u','w','uw'),('thetav','w','thetaw')]:
+        cov = ((unstacked[a]*unstacked[b]).resample('10min').mean()
+               - unstacked[a].resample('10min').mean()*unstacked[b].resample('10min').mean())
+        expected[name] = cov.stack()
+    expected = expected.reindex(stats.index)
+    np.testing.assert_array_equal(stats.values,expected[stats.columns].values)
+
+
+def test_fill_gaps_leaves_columns_without_data():
+    x = np.arange(6,dtype=np.float64)
+    # whole rows missing, and no valid samples at all
+    values = np.full((6,2),np.nan)
+    helpers.fill_gaps(x,values)
+    assert np.isnan(values).all()
+    # one column without any valid samples
+    values = np.array([[np.nan,np.nan,2.,np.nan,4.,np.nan],
+                       [np.nan]*6]).T
+    helpers.fill_gaps(x,values)
+    np.testing.assert_array_equal(values[:,0],[np.nan,np.nan,2.,3.,4.,4.])
+    assert np.isnan(values[:,1]).all()
+
+
+def test_cached_results_are_keyed_and_evicted(tmp_path,monkeypatch):
+    monkeypatch.setattr(helpers,'cachedir',str(tmp_path / 'cache'))
+    fpath = tmp_path / 'input.csv'
+    fpath.write_text('1,2,3\n')
+    calls = []
+
+    @helpers.cached(lambda fpath,**kwargs: [fpath])
+    def load(fpath,scale=1,nprocs=1):
+        calls.append((scale,nprocs))
+        return np.full(1000,float(scale))
+
+    np.testing.assert_array_equal(load(str(fpath)),np.ones(1000))
+    load(str(fpath))
+    load(str(fpath),nprocs=4) # the number of processes does not matter
+    load(str(fpath),scale=1)  # nor whether defaults are passed explicitly
+    assert len(calls) == 1
+    np.testing.assert_array_equal(load(str(fpath),scale=2),np.full(1000,2.))
+    assert len(calls) == 2
+
+    # a modified input file invalidates its results
+    st = os.stat(fpath)
+    os.utime(fpath,ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+    load(str(fpath))
+    assert len(calls) == 3
+
+    # beyond 'cachesize', the least recently used results are evicted
+    size = max(os.path.getsize(path) for path in (tmp_path / 'cache').iterdir())
+    monkeypatch.setattr(helpers,'cachesize',int(2.5*size))
+    load(str(fpath),scale=3) # evicts the stale result and scale=2
+    load(str(fpath),scale=1) # recently used, so kept when scale=4 is added
+    load(str(fpath),scale=4)
+    assert len(list((tmp_path / 'cache').iterdir())) == 2
+    del calls[:]
+    load(str(fpath),scale=1)
+    load(str(fpath),scale=4)
+    assert calls == []
+    load(str(fpath),scale=3)
+    assert calls == [(3,1)]